@@ -0,0 +1,485 @@
+"""
+Records book, format and chapter accesses.
+
+By default each access is written to the database as the request is served.
+Setting BOOKS_BUFFER_ACCESSES = True queues accesses in process instead and
+writes them with bulk_create from a background thread, either once
+BOOKS_ACCESS_BATCH_SIZE events are waiting or every
+BOOKS_ACCESS_FLUSH_INTERVAL seconds. Anything still queued is written when
+the process exits, but is lost if the process is killed, e.g. by a hard
+timeout. Events that fail to write are requeued, keeping at most
+BOOKS_ACCESS_MAX_QUEUED so that a database outage cannot exhaust memory;
+beyond that the oldest are dropped.
+
+Repeat accesses by the same session within BOOKS_ACCESS_DEDUPE_SECONDS
+(ten by default) are ignored. The window is tracked with short-lived keys in
+the BOOKS_ACCESS_DEDUPE_CACHE cache, falling back to querying BookAccess
+when that cache is a DummyCache.
+
+Country lookups are memoised: IP addresses are mapped to ISO codes through
+an LRU cache of BOOKS_GEOIP_CACHE_SIZE entries and ISO codes to Country ids
+through a map loaded once per process. country_cache_info reports hit and
+miss counts to help size the former.
+
+Robots are identified by matching the User-Agent header against a single
+precompiled expression built from COUNTER-style patterns. The defaults can
+be replaced with a BOOKS_ROBOT_PATTERNS list or a BOOKS_ROBOT_PATTERNS_FILE,
+either a COUNTER-Robots JSON file or one pattern per line, and are reloaded
+with reload_robot_patterns. Results are memoised per User-Agent string in an
+LRU cache of BOOKS_USER_AGENT_CACHE_SIZE entries.
+"""
+import atexit
+import json
+import os
+import re
+import threading
+from collections import namedtuple
+from datetime import timedelta
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.db import connections
+from django.utils import timezone
+
+from core import models as core_models
+from metrics.logic import get_iso_country_code
+from utils.logger import get_logger
+from utils.shared import get_ip_address
+from plugins.books import models
+
+logger = get_logger(__name__)
+
+AccessEvent = namedtuple(
+    'AccessEvent',
+    [
+        'book_id',
+        'format_id',
+        'chapter_id',
+        'type',
+        'identifier',
+        'ip',
+        'accessed',
+    ],
+)
+
+# A subset of the COUNTER-Robots list (github.com/atmire/COUNTER-Robots).
+DEFAULT_ROBOT_PATTERNS = (
+    r'bot',
+    r'^.?$',
+    r'spider',
+    r'crawl',
+    r'slurp',
+    r'archiver',
+    r'^ia_archiver',
+    r'^Apache-HttpClient',
+    r'^curl',
+    r'^Wget',
+    r'^Java\/\d',
+    r'^python',
+    r'^Python-urllib',
+    r'python-requests',
+    r'aiohttp',
+    r'^Go-http-client',
+    r'^okhttp',
+    r'^libwww',
+    r'^lwp',
+    r'^Ruby',
+    r'^PHP',
+    r'^Scrapy',
+    r'HTTrack',
+    r'mechanize',
+    r'HeadlessChrome',
+    r'PhantomJS',
+    r'facebookexternalhit',
+    r'BingPreview',
+    r'Google Web Preview',
+    r'Mediapartners-Google',
+    r'^Mozilla\/4\.0$',
+    r'^Mozilla\/5\.0$',
+    r'Citoid',
+    r'Zotero',
+    r'Mendeley',
+    r'Feedfetcher',
+    r'^Feedly',
+    r'LinkChecker',
+    r'checklink',
+    r'^Nutch',
+    r'^Jakarta',
+    r'^Lynx',
+    r'^node-fetch',
+    r'^axios',
+    r'httpunit',
+    r'^Pingdom',
+    r'UptimeRobot',
+    r'^Screaming Frog',
+    r'^CCBot',
+    r'^Sogou',
+    r'^Baiduspider',
+    r'^Yandex',
+    r'^AhrefsBot',
+    r'^SemrushBot',
+    r'^MJ12bot',
+    r'^DotBot',
+    r'^PetalBot',
+    r'^Bytespider',
+    r'^GPTBot',
+    r'^ClaudeBot',
+)
+
+robot_matcher = None
+robot_matcher_lock = threading.Lock()
+
+
+def load_robot_patterns():
+    """
+    Returns the configured robot patterns.
+    """
+    path = getattr(settings, 'BOOKS_ROBOT_PATTERNS_FILE', None)
+
+    if path:
+        with open(path, encoding='utf-8') as patterns_file:
+            if path.endswith('.json'):
+                return [entry['pattern'] for entry in json.load(patterns_file)]
+            return [line.strip() for line in patterns_file if line.strip()]
+
+    return getattr(settings, 'BOOKS_ROBOT_PATTERNS', DEFAULT_ROBOT_PATTERNS)
+
+
+def compile_robot_patterns(patterns):
+    return re.compile(
+        '|'.join('(?:{0})'.format(pattern) for pattern in patterns),
+        re.IGNORECASE,
+    )
+
+
+def reload_robot_patterns():
+    """
+    Recompiles the robot matcher from the current settings and discards
+    memoised classifications.
+    """
+    global robot_matcher
+    with robot_matcher_lock:
+        robot_matcher = compile_robot_patterns(load_robot_patterns())
+        is_robot_user_agent.cache_clear()
+
+
+@lru_cache(maxsize=getattr(settings, 'BOOKS_USER_AGENT_CACHE_SIZE', 1024))
+def is_robot_user_agent(user_agent):
+    """
+    Checks a raw User-Agent string against the robot patterns.
+    :param user_agent: str or None
+    :return: bool
+    """
+    if robot_matcher is None:
+        reload_robot_patterns()
+
+    return bool(robot_matcher.search(user_agent or ''))
+
+
+def buffering_enabled():
+    return getattr(settings, 'BOOKS_BUFFER_ACCESSES', False)
+
+
+def get_dedupe_cache():
+    cache = caches[getattr(settings, 'BOOKS_ACCESS_DEDUPE_CACHE', 'default')]
+    if isinstance(cache, DummyCache):
+        return None
+    return cache
+
+
+def recent_accesses(book_id, format_id, chapter_id, access_type, identifier,
+                    since):
+    """
+    Returns a session's BookAccess rows for an item since a given time,
+    which is_repeat_access checks for when there is no dedupe cache.
+    """
+    return models.BookAccess.objects.filter(
+        book_id=book_id,
+        format_id=format_id,
+        chapter_id=chapter_id,
+        accessed__gte=since,
+        type=access_type,
+        identifier=identifier,
+    )
+
+
+def is_repeat_access(book_id, format_id, chapter_id, access_type, identifier):
+    """
+    Checks whether a session has accessed an item within the dedupe window,
+    marking it as accessed if not.
+    :return: bool, True if the access should not be recorded
+    """
+    window = getattr(settings, 'BOOKS_ACCESS_DEDUPE_SECONDS', 10)
+    cache = get_dedupe_cache()
+
+    if cache is not None:
+        key = 'books_access:{0}:{1}:{2}:{3}:{4}'.format(
+            identifier,
+            book_id,
+            format_id,
+            chapter_id,
+            access_type,
+        )
+        return not cache.add(key, True, timeout=window)
+
+    time_to_check = timezone.now() - timedelta(seconds=window)
+    check = recent_accesses(
+        book_id,
+        format_id,
+        chapter_id,
+        access_type,
+        identifier,
+        time_to_check,
+    ).exists()
+
+    if not check and buffering_enabled():
+        check = access_buffer.is_pending(
+            book_id,
+            format_id,
+            chapter_id,
+            access_type,
+            identifier,
+            time_to_check,
+        )
+
+    return check
+
+
+@lru_cache(maxsize=getattr(settings, 'BOOKS_GEOIP_CACHE_SIZE', 4096))
+def get_country_code(ip):
+    return get_iso_country_code(ip)
+
+
+country_ids = {}
+country_ids_lock = threading.Lock()
+
+
+def get_country_id(iso_country_code):
+    """
+    Returns the pk of the Country with the given ISO code, loading all
+    Country codes on first use.
+    """
+    if not country_ids:
+        with country_ids_lock:
+            if not country_ids:
+                country_ids.update(
+                    core_models.Country.objects.values_list('code', 'pk')
+                )
+    return country_ids.get(iso_country_code)
+
+
+def country_cache_info():
+    """
+    Returns hit and miss counts for this process's IP to country cache.
+    """
+    info = get_country_code.cache_info()
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'size': info.currsize,
+        'max_size': info.maxsize,
+    }
+
+
+def write_events(events, batch_size=None):
+    """
+    Saves a list of AccessEvents.
+    :param events: list of AccessEvent
+    :param batch_size: int, passed on to bulk_create
+    :return: list of the created BookAccess objects
+    """
+    accesses = [
+        models.BookAccess(
+            book_id=event.book_id,
+            format_id=event.format_id,
+            chapter_id=event.chapter_id,
+            type=event.type,
+            identifier=event.identifier,
+            country_id=get_country_id(get_country_code(event.ip)),
+            accessed=event.accessed,
+        ) for event in events
+    ]
+
+    return models.BookAccess.objects.bulk_create(
+        accesses,
+        batch_size=batch_size,
+    )
+
+
+class AccessBuffer(object):
+    """
+    An in-process queue of AccessEvents flushed by a daemon thread.
+    The thread is started on first use so that each worker process of a
+    pre-forking server gets its own.
+
+    A flush holds flush_lock from taking events off the queue until they are
+    written, so the final flush at exit waits for one already in progress
+    on the thread before draining whatever is left.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = False
+        self.thread = None
+        self.pid = None
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'BOOKS_ACCESS_BATCH_SIZE', 100)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'BOOKS_ACCESS_FLUSH_INTERVAL', 5)
+
+    @property
+    def max_queued(self):
+        return getattr(settings, 'BOOKS_ACCESS_MAX_QUEUED', 10000)
+
+    def add(self, event):
+        with self.lock:
+            self.start()
+            self.events.append(event)
+            if len(self.events) >= self.batch_size:
+                self.wake.set()
+
+    def is_pending(self, book_id, format_id, chapter_id, access_type,
+                   identifier, since):
+        with self.lock:
+            return any(
+                event.book_id == book_id
+                and event.format_id == format_id
+                and event.chapter_id == chapter_id
+                and event.type == access_type
+                and event.identifier == identifier
+                and event.accessed >= since
+                for event in self.events
+            )
+
+    def start(self):
+        if self.pid != os.getpid():
+            # Events queued in a parent process are flushed by the parent,
+            # which may have been mid-flush when this process was forked.
+            self.events = []
+            self.flush_lock = threading.Lock()
+            self.thread = None
+            self.pid = os.getpid()
+
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(
+                target=self.run,
+                name='books-access-buffer',
+                daemon=True,
+            )
+            self.thread.start()
+
+    def run(self):
+        while not self.stopping:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+            connections.close_all()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                events, self.events = self.events, []
+
+            if not events:
+                return
+
+            try:
+                write_events(events, batch_size=self.batch_size)
+            except Exception:
+                logger.exception(
+                    'Failed to write {0} book accesses, requeueing.'.format(
+                        len(events),
+                    )
+                )
+                self.requeue(events)
+
+    def requeue(self, events):
+        """
+        Puts events that failed to write back at the head of the queue,
+        dropping the oldest beyond max_queued.
+        """
+        with self.lock:
+            self.events = events + self.events
+            dropped = len(self.events) - self.max_queued
+            if dropped > 0:
+                del self.events[:dropped]
+
+        if dropped > 0:
+            logger.error(
+                'Dropped {0} book accesses, more than {1} were queued.'.format(
+                    dropped,
+                    self.max_queued,
+                )
+            )
+
+    def close(self):
+        """
+        Stops the thread and writes any queued events. Called at exit.
+        """
+        self.stopping = True
+        self.wake.set()
+        self.flush()
+
+
+access_buffer = AccessBuffer()
+atexit.register(access_buffer.close)
+
+
+def record_book_access(request, book, access_type, format=None, chapter=None):
+    """
+    Records an access to a book format or chapter, ignoring bots and
+    repeat accesses by the same session within the dedupe window.
+    :param request: HttpRequest
+    :param book: Book object
+    :param access_type: str, one of models.access_choices
+    :param format: optional Format object
+    :param chapter: optional Chapter object
+    """
+    if is_robot_user_agent(request.META.get('HTTP_USER_AGENT')):
+        return
+
+    identifier = request.session.session_key
+    format_id = format.pk if format else None
+    chapter_id = chapter.pk if chapter else None
+
+    if is_repeat_access(
+        book.pk,
+        format_id,
+        chapter_id,
+        access_type,
+        identifier,
+    ):
+        return
+
+    ip = get_ip_address(request)
+
+    if buffering_enabled():
+        access_buffer.add(
+            AccessEvent(
+                book_id=book.pk,
+                format_id=format_id,
+                chapter_id=chapter_id,
+                type=access_type,
+                identifier=identifier,
+                ip=ip,
+                accessed=timezone.now(),
+            )
+        )
+    else:
+        models.BookAccess.objects.create(
+            book=book,
+            format=format,
+            chapter=chapter,
+            type=access_type,
+            country_id=get_country_id(get_country_code(ip)),
+            identifier=identifier,
+        )
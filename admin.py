@@ -22,11 +22,31 @@ class BookAccessAdmin(admin.ModelAdmin):
     search_fields = ('book__title',)
 
 
+class BookAccessMonthlyAdmin(admin.ModelAdmin):
+    list_display = ('book', 'month', 'type', 'format', 'chapter', 'country', 'count')
+    list_filter = ('book', 'type')
+    search_fields = ('book__title',)
+
+
+class BookAccessDailyAdmin(admin.ModelAdmin):
+    list_display = ('book', 'day', 'type', 'format', 'chapter', 'country', 'count')
+    list_filter = ('book', 'type')
+    search_fields = ('book__title',)
+
+
+class DeletedBookAdmin(admin.ModelAdmin):
+    list_display = ('title', 'book_id', 'isbn', 'doi', 'deleted')
+    search_fields = ('title', 'isbn', 'doi')
+
+
 admin_list = [
     (Book, ),
     (Contributor,),
     (Format,),
     (BookAccess, BookAccessAdmin),
+    (BookAccessMonthly, BookAccessMonthlyAdmin),
+    (BookAccessDaily, BookAccessDailyAdmin),
+    (DeletedBook, DeletedBookAdmin),
     (Chapter, ChapterAdmin),
     (Category,),
     (BookSetting, BookSettingAdmin)
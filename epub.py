@@ -0,0 +1,131 @@
+"""
+Serves individual entries from EPUB files so that the reader only fetches
+the parts of a book it displays.
+
+The central directory of each EPUB is read once and kept in an LRU cache
+of BOOKS_EPUB_INDEX_CACHE_SIZE entries, keyed by the file's path, mtime and
+size so that replacing a file is picked up without clearing the cache.
+Entries are then read straight from their offsets in the archive.
+"""
+import mimetypes
+import os
+import struct
+import zipfile
+import zlib
+from collections import namedtuple
+from functools import lru_cache
+
+from django.conf import settings
+
+EpubEntry = namedtuple(
+    'EpubEntry',
+    [
+        'name',
+        'header_offset',
+        'compress_type',
+        'compress_size',
+        'file_size',
+        'crc',
+        'encrypted',
+    ],
+)
+
+# Signature, versions, flags, method, time, date, CRC, sizes and the
+# lengths of the name and extra fields.
+LOCAL_HEADER_FORMAT = '<4s5H3L2H'
+LOCAL_HEADER_SIZE = struct.calcsize(LOCAL_HEADER_FORMAT)
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+CONTENT_TYPES = {
+    '.opf': 'application/oebps-package+xml',
+    '.ncx': 'application/x-dtbncx+xml',
+    '.xhtml': 'application/xhtml+xml',
+    '.xml': 'application/xml',
+    '.css': 'text/css',
+    '.svg': 'image/svg+xml',
+    '.otf': 'font/otf',
+    '.ttf': 'font/ttf',
+    '.woff': 'font/woff',
+    '.woff2': 'font/woff2',
+}
+
+
+class EpubError(Exception):
+    pass
+
+
+def get_index(file_path):
+    """
+    Returns the central directory of an EPUB as a dict of entry name to
+    EpubEntry.
+    :param file_path: str absolute path to the EPUB
+    """
+    stat = os.stat(file_path)
+    return read_index(file_path, stat.st_mtime, stat.st_size)
+
+
+@lru_cache(maxsize=getattr(settings, 'BOOKS_EPUB_INDEX_CACHE_SIZE', 64))
+def read_index(file_path, mtime, size):
+    try:
+        with zipfile.ZipFile(file_path) as archive:
+            return {
+                info.filename: EpubEntry(
+                    name=info.filename,
+                    header_offset=info.header_offset,
+                    compress_type=info.compress_type,
+                    compress_size=info.compress_size,
+                    file_size=info.file_size,
+                    crc=info.CRC,
+                    encrypted=bool(info.flag_bits & 0x1),
+                ) for info in archive.infolist() if not info.is_dir()
+            }
+    except zipfile.BadZipFile as e:
+        raise EpubError(str(e))
+
+
+def read_entry(file_path, entry):
+    """
+    Reads and decompresses a single entry using its offset from the index.
+    Entries that are neither stored nor deflated are left to zipfile.
+    :param file_path: str absolute path to the EPUB
+    :param entry: EpubEntry
+    :return: bytes
+    """
+    if entry.encrypted:
+        raise EpubError('{0} is encrypted.'.format(entry.name))
+
+    if entry.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        with zipfile.ZipFile(file_path) as archive:
+            return archive.read(entry.name)
+
+    with open(file_path, 'rb') as epub_file:
+        epub_file.seek(entry.header_offset)
+        header = struct.unpack(
+            LOCAL_HEADER_FORMAT,
+            epub_file.read(LOCAL_HEADER_SIZE),
+        )
+        if header[0] != LOCAL_HEADER_SIGNATURE:
+            raise EpubError('Bad local header for {0}.'.format(entry.name))
+
+        epub_file.seek(header[-2] + header[-1], os.SEEK_CUR)
+        data = epub_file.read(entry.compress_size)
+
+    if entry.compress_type == zipfile.ZIP_DEFLATED:
+        try:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        except zlib.error as e:
+            raise EpubError(str(e))
+
+    if zlib.crc32(data) != entry.crc:
+        raise EpubError('Bad CRC for {0}.'.format(entry.name))
+
+    return data
+
+
+def get_content_type(name):
+    extension = os.path.splitext(name)[1].lower()
+    if extension in CONTENT_TYPES:
+        return CONTENT_TYPES[extension]
+
+    content_type, encoding = mimetypes.guess_type(name)
+    return content_type or 'application/octet-stream'
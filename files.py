@@ -1,10 +1,18 @@
 import os
+from urllib.parse import quote
 from uuid import uuid4
-from wsgiref.util import FileWrapper
+import magic
 from csv import DictReader
 
 from django.conf import settings
-from django.http import StreamingHttpResponse, Http404
+from django.core.files.images import get_image_dimensions
+from django.http import (
+    FileResponse,
+    HttpResponse,
+    StreamingHttpResponse,
+    Http404,
+)
+from django.utils.http import http_date, parse_http_date_safe
 from django.utils.text import slugify
 from django.utils import dateparse
 
@@ -17,6 +25,10 @@ CSV_EXAMPLE = ['The', 'Lord of the Rings', 'Fellowship if the Ring', 'Hobbit tak
                '0', '1954-07-29', 'Allen and Unwin', 'London', '10.1234/123.1', '0618346252',
                'https://www.amazon.com/Fellowship-Ring-Being-First-Rings/dp/0547928211/']
 temp_directory = os.path.join(settings.BASE_DIR, 'files', 'temp')
+EPUB_MIME_TYPE = 'application/epub+zip'
+# Stored for files whose type could not be detected, e.g. missing files.
+UNKNOWN_MIME_TYPE = 'application/octet-stream'
+MAX_RANGES = 20
 
 
 def delete_book_file(filename):
@@ -39,26 +51,24 @@ def save_file_to_disk(file_to_save, book_format):
     return filename
 
 
-def serve_book_file(book_format):
+def serve_book_file(book_format, request=None, etag=None, last_modified=None):
     file_path = os.path.join(settings.BASE_DIR, 'files', 'press', 'books', book_format.filename)
 
     if os.path.isfile(file_path):
         filename, extension = os.path.splitext(book_format.filename)
-        response = StreamingHttpResponse(FileWrapper(open(file_path, 'rb'), 8192),
-                                         content_type=files.guess_mime(book_format.filename))
-        response['Content-Length'] = os.path.getsize(file_path)
-        response['Content-Disposition'] = 'attachment;' \
-                                          ' filename="{0}{1}"'.format(
-            slugify(book_format.book.full_title()),
-            extension
+        return serve_file(
+            request,
+            file_path,
+            '{0}{1}'.format(slugify(book_format.book.full_title()), extension),
+            files.guess_mime(book_format.filename),
+            etag=etag,
+            last_modified=last_modified,
         )
-
-        return response
     else:
         raise Http404
 
 
-def server_chapter_file(book_chapter):
+def server_chapter_file(book_chapter, request=None, etag=None, last_modified=None):
     file_path = os.path.join(
         settings.BASE_DIR,
         'files',
@@ -69,28 +79,311 @@ def server_chapter_file(book_chapter):
 
     if os.path.isfile(file_path):
         filename, extension = os.path.splitext(book_chapter.filename)
-        response = StreamingHttpResponse(
-            FileWrapper(open(file_path, 'rb'), 8192),
-            content_type=files.guess_mime(book_chapter.filename),
+        return serve_file(
+            request,
+            file_path,
+            '{0}{1}'.format(slugify(book_chapter.title), extension),
+            files.guess_mime(book_chapter.filename),
+            etag=etag,
+            last_modified=last_modified,
         )
-        response['Content-Length'] = os.path.getsize(file_path)
-        response['Content-Disposition'] = 'attachment;' \
-                                          ' filename="{0}{1}"'.format(
-            slugify(book_chapter.title),
-            extension
+    else:
+        raise Http404
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range_header(header, size):
+    """
+    Parses a Range header into a list of inclusive byte ranges.
+    :param header: str value of the Range header, or None
+    :param size: int size of the file
+    :return: sorted list of (start, end) tuples, or None if the whole file
+    should be served
+    :raises RangeNotSatisfiable: if no range overlaps the file
+    """
+    if not header:
+        return None
+
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        start, sep, end = spec.strip().partition('-')
+        if not sep:
+            return None
+
+        try:
+            if not start:
+                suffix_length = int(end)
+                if not suffix_length:
+                    continue
+                start, end = max(size - suffix_length, 0), size - 1
+            else:
+                start = int(start)
+                if not end:
+                    end = size - 1
+                elif int(end) < start:
+                    return None
+                else:
+                    end = int(end)
+        except ValueError:
+            return None
+
+        # Ranges starting past the end of the file cannot be satisfied.
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+
+    if not ranges:
+        raise RangeNotSatisfiable
+
+    # Coalesce overlapping or adjacent ranges.
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    if len(merged) > MAX_RANGES:
+        return None
+
+    return merged
+
+
+def is_continuation_request(request):
+    """
+    Checks whether a request only asks for part of a file after its first
+    byte, i.e. a resumed download or a viewer fetching later pages. These
+    should not be recorded as new accesses.
+    """
+    header = request.META.get('HTTP_RANGE', '')
+    unit, _, specs = header.partition('=')
+
+    if unit.strip().lower() != 'bytes' or not specs.strip():
+        return False
+
+    return not any(
+        spec.strip().partition('-')[0].strip() == '0'
+        for spec in specs.split(',')
+    )
+
+
+def get_block_size():
+    return getattr(settings, 'BOOKS_FILE_BLOCK_SIZE', 64 * 1024)
+
+
+def read_file_range(file_path, start, end, block_size=None):
+    """
+    Yields the bytes from start to end inclusive. The file is closed when
+    the generator is exhausted or closed, which StreamingHttpResponse does
+    once the response has been sent or the client has gone away.
+    """
+    block_size = block_size or get_block_size()
+    with open(file_path, 'rb') as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = file.read(min(block_size, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+def read_file_ranges(file_path, ranges, boundary, content_type, size):
+    for start, end in ranges:
+        yield multipart_range_header(boundary, content_type, start, end, size)
+        for block in read_file_range(file_path, start, end):
+            yield block
+    yield '\r\n--{0}--\r\n'.format(boundary).encode('ascii')
+
+
+def multipart_range_header(boundary, content_type, start, end, size):
+    return (
+        '\r\n--{0}\r\n'
+        'Content-Type: {1}\r\n'
+        'Content-Range: bytes {2}-{3}/{4}\r\n\r\n'
+    ).format(boundary, content_type, start, end, size).encode('ascii')
+
+
+def serve_file(request, file_path, download_name, content_type,
+               etag=None, last_modified=None):
+    """
+    Streams a file as an attachment, honouring single and multiple byte
+    Range requests. Whole files are sent with a FileResponse so that WSGI
+    servers providing wsgi.file_wrapper can use sendfile.
+    :param request: HttpRequest or None
+    :param file_path: str absolute path to the file
+    :param download_name: str filename to offer the client
+    :param content_type: str MIME type
+    :param etag: optional quoted ETag for the file
+    :param last_modified: optional int timestamp of the file's last change
+    :return: FileResponse, StreamingHttpResponse or HttpResponse
+    """
+    backend = getattr(settings, 'BOOKS_FILE_SERVING_BACKEND', 'stream')
+    if backend in ('x-accel-redirect', 'x-sendfile'):
+        return offload_file(
+            backend,
+            file_path,
+            download_name,
+            content_type,
+            etag=etag,
+            last_modified=last_modified,
         )
 
-        return response
+    size = os.path.getsize(file_path)
+    ranges = None
+
+    if request is not None and if_range_matches(request, etag, last_modified):
+        try:
+            ranges = parse_range_header(request.META.get('HTTP_RANGE'), size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{0}'.format(size)
+            return response
+
+    if not ranges:
+        response = FileResponse(
+            open(file_path, 'rb'),
+            content_type=content_type,
+        )
+        response.block_size = get_block_size()
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(
+            read_file_range(file_path, start, end),
+            content_type=content_type,
+            status=206,
+        )
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end, size)
     else:
-        raise Http404
+        boundary = uuid4().hex
+        response = StreamingHttpResponse(
+            read_file_ranges(file_path, ranges, boundary, content_type, size),
+            content_type='multipart/byteranges; boundary={0}'.format(boundary),
+            status=206,
+        )
+        response['Content-Length'] = sum(
+            len(multipart_range_header(boundary, content_type, start, end, size))
+            + end - start + 1
+            for start, end in ranges
+        ) + len('\r\n--{0}--\r\n'.format(boundary))
+
+    response['Accept-Ranges'] = 'bytes'
+
+    return set_file_headers(response, download_name, etag, last_modified)
+
+
+def offload_file(backend, file_path, download_name, content_type,
+                 etag=None, last_modified=None):
+    """
+    Hands a file to the web server to send, using nginx's X-Accel-Redirect
+    or Apache/lighttpd's X-Sendfile. The web server then deals with Range
+    requests and slow clients.
+    :param backend: str, 'x-accel-redirect' or 'x-sendfile'
+    :return: HttpResponse with no body
+    """
+    response = HttpResponse(content_type=content_type)
+
+    if backend == 'x-accel-redirect':
+        relative_path = os.path.relpath(
+            file_path,
+            os.path.join(settings.BASE_DIR, 'files', 'press', 'books'),
+        )
+        response['X-Accel-Redirect'] = '{0}{1}'.format(
+            getattr(
+                settings,
+                'BOOKS_X_ACCEL_REDIRECT_PREFIX',
+                '/protected-books/',
+            ),
+            quote(relative_path),
+        )
+    else:
+        response['X-Sendfile'] = file_path
+
+    return set_file_headers(response, download_name, etag, last_modified)
+
+
+def set_file_headers(response, download_name, etag=None, last_modified=None):
+    response['Content-Disposition'] = 'attachment; filename="{0}"'.format(
+        download_name,
+    )
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+
+    return response
+
+
+def if_range_matches(request, etag, last_modified):
+    """
+    Checks an If-Range precondition. Range requests whose If-Range no
+    longer matches the file get the whole file instead.
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
 
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return bool(etag) and if_range == etag
+    return bool(last_modified) and parse_http_date_safe(if_range) == last_modified
 
 
+def get_onix_feed_path():
+    return os.path.join(
+        settings.BASE_DIR,
+        'files',
+        'press',
+        'books',
+        'onix',
+        'onix.xml.gz',
+    )
+
 
 def get_file_path(book_format):
     return os.path.join(settings.BASE_DIR, 'files', 'press', 'books', book_format.filename)
 
 
+def detect_mime_type(book_file):
+    """
+    Sniffs the MIME type of a Format or Chapter file with libmagic.
+    :param book_file: Format or Chapter object
+    :return: str MIME type or None if the file is missing
+    """
+    if not book_file.filename:
+        return None
+
+    try:
+        return magic.from_file(get_file_path(book_file), mime=True)
+    except (IOError, OSError):
+        return None
+
+
+def get_cover_metadata(cover):
+    """
+    Reads the dimensions and MIME type of a book cover.
+    :param cover: FieldFile or uploaded file
+    :return: tuple of width, height and MIME type, each None if unknown
+    """
+    try:
+        width, height = get_image_dimensions(cover)
+        position = cover.tell()
+        cover.seek(0)
+        mime_type = magic.from_buffer(cover.read(2048), mime=True)
+        cover.seek(position)
+    except (IOError, OSError, ValueError):
+        return None, None, None
+
+    return width, height, mime_type
+
+
 def pre_process(uuid):
     out_text = ''
 
@@ -71,13 +71,14 @@ class FormatForm(forms.ModelForm):
 
     class Meta:
         model = models.Format
-        exclude = ('book', 'filename')
+        exclude = ('book', 'filename', 'mime_type')
 
     def save(self, commit=True, *args, **kwargs):
         save_format = super(FormatForm, self).save(commit=False)
         file = self.cleaned_data["file"]
         filename = files.save_file_to_disk(file, save_format)
         save_format.filename = filename
+        save_format.mime_type = files.detect_mime_type(save_format)
 
         if commit:
             save_format.save()
@@ -126,6 +127,7 @@ class ChapterForm(forms.ModelForm):
         if file:
             filename = files.save_file_to_disk(file, save_chapter)
             save_chapter.filename = filename
+            save_chapter.mime_type = files.detect_mime_type(save_chapter)
 
         if commit:
             save_chapter.save()
@@ -1,8 +1,33 @@
+import csv
+import re
+from collections import defaultdict
+from hashlib import md5
+from itertools import groupby
+
 from plugins.books import models
 from datetime import date, timedelta, datetime
 from dateutil.relativedelta import relativedelta
 
-from django.utils import timezone
+from django.conf import settings
+from django.db import transaction
+from django.db.models import (
+    Count,
+    DateField,
+    F,
+    IntegerField,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+)
+from django.db.models.functions import Coalesce, TruncDay, TruncMonth
+from django.http import StreamingHttpResponse
+from django.utils import dateparse, timezone
+from django.utils.http import http_date, quote_etag
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
 
 
 def get_first_day(dt, d_years=0, d_months=0):
@@ -59,44 +84,98 @@ def get_start_and_end_months(request):
     return start_month, end_month, date_parts
 
 
-def book_metrics_data(books, start_date, end_date):
+def book_metrics_querysets(books, start_date, end_date):
+    """
+    Returns the grouped queries book_metrics_data adds up: view and
+    download totals per book and per format, from both BookAccess and
+    BookAccessDaily.
+    :param books: Book queryset
+    :param start_date: date or ISO date string
+    :param end_date: date or ISO date string
+    :return: list of (queryset, field grouped by) tuples
+    """
+    accesses = models.BookAccess.objects.filter(
+        book__in=books,
+        accessed__gte=start_date,
+        accessed__lte=end_date,
+    )
+    totals = {
+        'views': Count('pk', filter=Q(type='view')),
+        'downloads': Count('pk', filter=Q(type='download')),
+    }
 
-    all_book_data = []
+    compacted = models.BookAccessDaily.objects.filter(
+        book__in=books,
+        day__gte=start_date,
+        day__lt=end_date,
+    )
+    compacted_totals = {
+        'views': Sum('count', filter=Q(type='view')),
+        'downloads': Sum('count', filter=Q(type='download')),
+    }
 
-    for book in books:
-        book_data = {}
-        book_accesses = models.BookAccess.objects.filter(
-            book=book,
+    return [
+        (rows.order_by(), field) for rows, field in (
+            (accesses.values('book').annotate(**totals), 'book'),
+            (compacted.values('book').annotate(**compacted_totals), 'book'),
+            (
+                accesses.filter(
+                    format__isnull=False,
+                ).values('format').annotate(**totals),
+                'format',
+            ),
+            (
+                compacted.filter(
+                    format__isnull=False,
+                ).values('format').annotate(**compacted_totals),
+                'format',
+            ),
         )
+    ]
 
-        views = book_accesses.filter(
-            type='view',
-            accessed__gte=start_date,
-            accessed__lte=end_date,
-        )
-        downloads = book_accesses.filter(
-            type='download',
-            accessed__gte=start_date,
-            accessed__lte=end_date,
-        )
 
-        book_data['book'] = book
-        book_data['views'] = views.count()
-        book_data['downloads'] = downloads.count()
-        book_data['formats'] = []
+def book_metrics_data(books, start_date, end_date):
+    """
+    Builds view and download totals for each book and its formats.
+    Totals come from grouped queries over BookAccess and BookAccessDaily so
+    the number of queries does not depend on the number of books or
+    formats.
+    :param books: Book queryset
+    :param start_date: date or ISO date string
+    :param end_date: date or ISO date string
+    :return: list of dicts, one per book
+    """
+    books = books.prefetch_related('format_set', 'contributor_set')
+    totals = {
+        'book': defaultdict(lambda: defaultdict(int)),
+        'format': defaultdict(lambda: defaultdict(int)),
+    }
+
+    for rows, field in book_metrics_querysets(books, start_date, end_date):
+        for row in rows:
+            for key in ('views', 'downloads'):
+                totals[field][row[field]][key] += row[key] or 0
+
+    book_totals, format_totals = totals['book'], totals['format']
+
+    all_book_data = []
+
+    for book in books:
+        book_row = book_totals.get(book.pk, {})
+        book_data = {
+            'book': book,
+            'views': book_row.get('views', 0),
+            'downloads': book_row.get('downloads', 0),
+            'formats': [],
+        }
 
         for format in book.format_set.all():
-            views = views.filter(
-                format=format,
-            )
-            downloads = downloads.filter(
-                format=format,
-            )
+            format_row = format_totals.get(format.pk, {})
             book_data['formats'].append(
                 {
                     'format': format,
-                    'views': views.count(),
-                    'downloads': downloads.count(),
+                    'views': format_row.get('views', 0),
+                    'downloads': format_row.get('downloads', 0),
                 }
             )
 
@@ -105,18 +184,54 @@ def book_metrics_data(books, start_date, end_date):
     return all_book_data
 
 
-def book_metrics_by_month(books, date_parts):
-    metrics = models.BookAccess.objects.all()
+def annotate_access_totals(books):
+    """
+    Annotates books with their all-time view and download totals.
+    :param books: Book queryset
+    :return: Book queryset with total_views and total_downloads
+    """
+    def compacted(access_type):
+        return Coalesce(
+            Subquery(
+                models.BookAccessDaily.objects.filter(
+                    book=OuterRef('pk'),
+                    type=access_type,
+                ).order_by().values(
+                    'book',
+                ).annotate(
+                    total=Sum('count'),
+                ).values(
+                    'total',
+                ),
+                output_field=IntegerField(),
+            ),
+            0,
+        )
 
+    return books.annotate(
+        total_views=Count(
+            'bookaccess',
+            filter=Q(bookaccess__type='view'),
+        ) + compacted('view'),
+        total_downloads=Count(
+            'bookaccess',
+            filter=Q(bookaccess__type='download'),
+        ) + compacted('download'),
+    )
+
+
+def get_report_months(date_parts):
+    """
+    Lists the first day of each month covered by a by-month report.
+    :param date_parts: dict as returned by get_start_and_end_months
+    :return: list of dates
+    """
     start_str = '{}-01'.format(date_parts.get('start_unsplit'))
     end_str = '{}-27'.format(date_parts.get('end_unsplit'))
 
     start = datetime.strptime(start_str, '%Y-%m-%d').date()
     end = datetime.strptime(end_str, '%Y-%m-%d').date()
 
-    current_year = date_parts.get('end_month_y')
-    previous_year = str(int(current_year) - 1)
-
     dates = [start]
 
     while start < end:
@@ -124,31 +239,488 @@ def book_metrics_by_month(books, date_parts):
         if start < end:
             dates.append(start)
 
-    data = []
+    return dates
+
+
+def add_to_access_aggregate(model, row, **period):
+    """
+    Adds a grouped BookAccess total to the matching BookAccessMonthly or
+    BookAccessDaily row, creating it if needed.
+    :param model: BookAccessMonthly or BookAccessDaily
+    :param row: dict with book, format, chapter, type, country and total
+    :param period: the month or day field and its value
+    """
+    key = {
+        'book_id': row['book'],
+        'format_id': row['format'],
+        'chapter_id': row['chapter'],
+        'type': row['type'],
+        'country_id': row['country'],
+    }
+    key.update(period)
 
-    for book in books:
-        book_metrics = metrics.filter(book=book)
-        book_data = {'book': book, 'all_metrics': book_metrics}
+    updated = model.objects.filter(
+        **key
+    ).update(
+        count=F('count') + row['total'],
+    )
+    if not updated:
+        model.objects.create(
+            count=row['total'],
+            **key
+        )
+
+
+def get_rollup_high_water(grace_minutes=None):
+    """
+    Returns the highest BookAccess id that is safe to roll up: that of the
+    newest row accessed more than BOOKS_ROLLUP_GRACE_MINUTES ago. Ids are
+    allocated before rows are committed, so rows with lower ids than the
+    newest committed row may still be in flight, e.g. in a buffered
+    bulk_create. Holding the mark back by the grace period gives them time
+    to commit rather than being skipped for good.
+    :param grace_minutes: int, defaults to BOOKS_ROLLUP_GRACE_MINUTES
+    :return: int
+    """
+    if grace_minutes is None:
+        grace_minutes = getattr(settings, 'BOOKS_ROLLUP_GRACE_MINUTES', 10)
+
+    cutoff = timezone.now() - timedelta(minutes=grace_minutes)
+    return models.BookAccess.objects.filter(
+        accessed__lt=cutoff,
+    ).order_by(
+        '-pk',
+    ).values_list(
+        'pk',
+        flat=True,
+    ).first() or 0
+
+
+def rollup_book_accesses(batch_size=50000, grace_minutes=None):
+    """
+    Folds BookAccess rows newer than the stored high-water mark into
+    BookAccessMonthly. Each batch is committed along with the new mark so
+    an interrupted run can simply be started again.
+    :param batch_size: int, the number of BookAccess ids per transaction
+    :param grace_minutes: int, see get_rollup_high_water
+    :return: int, the number of BookAccess rows processed
+    """
+    if not models.BookAccessRollupState.objects.exists():
+        models.BookAccessRollupState.objects.create()
+
+    high_water = get_rollup_high_water(grace_minutes)
+    processed = 0
+
+    while True:
+        with transaction.atomic():
+            state = models.BookAccessRollupState.objects.select_for_update(
+            ).first()
+
+            if state.last_access_id >= high_water:
+                break
+
+            upper = min(state.last_access_id + batch_size, high_water)
+            rows = models.BookAccess.objects.filter(
+                pk__gt=state.last_access_id,
+                pk__lte=upper,
+            ).annotate(
+                month=TruncMonth('accessed', output_field=DateField()),
+            ).order_by().values(
+                'book', 'format', 'chapter', 'type', 'country', 'month',
+            ).annotate(
+                total=Count('pk'),
+            )
+
+            for row in rows:
+                processed += row['total']
+                add_to_access_aggregate(
+                    models.BookAccessMonthly,
+                    row,
+                    month=row['month'],
+                )
+
+            state.last_access_id = upper
+            state.last_run = timezone.now()
+            state.save()
+
+    return processed
+
+
+def compact_book_accesses(before, batch_size=10000, progress=None):
+    """
+    Folds BookAccess rows recorded before a cutoff into BookAccessDaily and
+    deletes them. Only rows already rolled up into BookAccessMonthly are
+    compacted. Each batch is folded and deleted in one transaction, so an
+    interrupted run can simply be started again. Batches hold a lock on
+    BookAccessRollupState, as rollup_book_accesses does, so overlapping
+    runs take turns rather than folding the same rows twice.
+    :param before: datetime, rows accessed before this are compacted
+    :param batch_size: int, the number of rows per transaction
+    :param progress: optional callable, passed the running total after
+    each batch
+    :return: int, the number of BookAccess rows compacted
+    """
+    if not models.BookAccessRollupState.objects.exists():
+        return 0
+
+    compacted = 0
+    # Earlier batches are deleted, so start each one after the last.
+    last_pk = 0
+
+    while True:
+        with transaction.atomic():
+            state = models.BookAccessRollupState.objects.select_for_update(
+            ).first()
+            ids = list(
+                models.BookAccess.objects.filter(
+                    accessed__lt=before,
+                    pk__gt=last_pk,
+                    pk__lte=state.last_access_id,
+                ).order_by(
+                    'pk',
+                ).values_list(
+                    'pk',
+                    flat=True,
+                )[:batch_size]
+            )
 
-        date_metrics_list = []
+            if not ids:
+                break
 
-        for date in dates:
-            date_metrics = book_metrics.filter(
-                accessed__month=date.month,
-                accessed__year=date.year,
+            batch = models.BookAccess.objects.filter(pk__in=ids)
+            rows = batch.annotate(
+                day=TruncDay('accessed', output_field=DateField()),
+            ).order_by().values(
+                'book', 'format', 'chapter', 'type', 'country', 'day',
+            ).annotate(
+                total=Count('pk'),
             )
-            date_metrics_list.append(date_metrics.count())
 
-        book_data['date_metrics'] = date_metrics_list
+            for row in rows:
+                add_to_access_aggregate(
+                    models.BookAccessDaily,
+                    row,
+                    day=row['day'],
+                )
+
+            batch.delete()
+
+        last_pk = ids[-1]
+        compacted += len(ids)
+        logger.info('Compacted {0} book accesses.'.format(compacted))
+        if progress:
+            progress(compacted)
+
+    return compacted
+
+
+def monthly_rollup_rows(books, start, end, fields=('book',)):
+    """
+    Returns BookAccessMonthly totals grouped by fields and month.
+    :param books: Book queryset
+    :param start: date, the first month to include
+    :param end: date, the last month to include
+    :param fields: tuple of field names to group by
+    :return: values queryset of dicts with fields, month and total
+    """
+    return models.BookAccessMonthly.objects.filter(
+        book__in=books,
+        month__gte=start,
+        month__lte=end,
+    ).values(
+        *fields, 'month'
+    ).annotate(
+        total=Sum('count'),
+    ).order_by(
+        *fields, 'month'
+    )
+
+
+def monthly_unrolled_rows(books, start, end, fields=('book',)):
+    """
+    Returns totals for BookAccess rows not yet folded into
+    BookAccessMonthly, grouped by fields and month.
+    :param books: Book queryset
+    :param start: date, the first month to include
+    :param end: date, the last month to include
+    :param fields: tuple of field names to group by
+    :return: values queryset of dicts with fields, month and total
+    """
+    state = models.BookAccessRollupState.objects.first()
+    last_access_id = state.last_access_id if state else 0
+
+    return models.BookAccess.objects.filter(
+        book__in=books,
+        pk__gt=last_access_id,
+    ).annotate(
+        month=TruncMonth('accessed', output_field=DateField()),
+    ).filter(
+        month__gte=start,
+        month__lt=end + relativedelta(months=1),
+    ).order_by().values(
+        *fields, 'month'
+    ).annotate(
+        total=Count('pk'),
+    )
+
+
+def monthly_access_counts(books, start, end, fields=('book',)):
+    """
+    Totals accesses per month from BookAccessMonthly, adding any raw
+    BookAccess rows that have not been rolled up yet.
+    :param books: Book queryset
+    :param start: date, the first month to include
+    :param end: date, the last month to include
+    :param fields: tuple of field names to group by
+    :return: dict keyed by the grouped field values followed by the month
+    """
+    counts = defaultdict(int)
+
+    for rows in (
+        monthly_rollup_rows(books, start, end, fields),
+        monthly_unrolled_rows(books, start, end, fields),
+    ):
+        for row in rows:
+            key = tuple(row[field] for field in fields) + (row['month'],)
+            counts[key] += row['total']
+
+    return counts
+
+
+def book_metrics_by_month(books, date_parts):
+    dates = get_report_months(date_parts)
+
+    current_year = dates[-1].year
+    previous_year = current_year - 1
+
+    month_counts = monthly_access_counts(books, dates[0], dates[-1])
+    year_counts = defaultdict(int)
+
+    for (book_id, month), total in monthly_access_counts(
+        books,
+        date(previous_year, 1, 1),
+        date(current_year, 12, 1),
+    ).items():
+        year_counts[(book_id, month.year)] += total
+
+    data = []
+
+    for book in books:
+        book_data = {
+            'book': book,
+            'date_metrics': [
+                month_counts.get((book.pk, month), 0) for month in dates
+            ],
+        }
 
         for year in [current_year, previous_year]:
-            book_data[year] = book_metrics.filter(
-                accessed__year=year,
-            ).count()
+            book_data[str(year)] = year_counts.get((book.pk, year), 0)
 
         data.append(book_data)
 
-    return data, dates, current_year, previous_year
+    return data, dates, str(current_year), str(previous_year)
+
+
+class Echo(object):
+    """
+    A file-like object that hands back whatever is written to it, so
+    csv.writer can produce lines for a StreamingHttpResponse.
+    """
+
+    def write(self, value):
+        return value
+
+
+def metrics_by_month_rows(books, dates, breakdown=None):
+    """
+    Yields the rows of the by-month report one book at a time, reading
+    monthly totals from a single ordered query.
+    :param books: Book queryset
+    :param dates: list of dates as returned by get_report_months
+    :param breakdown: None, 'format' or 'chapter'
+    :return: generator of lists
+    """
+    if breakdown in ('format', 'chapter'):
+        fields = ('book', breakdown, '{}__title'.format(breakdown))
+    else:
+        breakdown, fields = None, ('book',)
+
+    header = ['ID', 'Title']
+    if breakdown:
+        header.append(breakdown.capitalize())
+    yield header + ['{0} {1}'.format(d.month, d.year) for d in dates]
+
+    unrolled = defaultdict(list)
+    for row in monthly_unrolled_rows(books, dates[0], dates[-1], fields):
+        unrolled[row['book']].append(row)
+
+    rollup = groupby(
+        monthly_rollup_rows(
+            books,
+            dates[0],
+            dates[-1],
+            fields,
+        ).iterator(chunk_size=2000),
+        key=lambda row: row['book'],
+    )
+    current = next(rollup, None)
+
+    for book in books.order_by('pk').iterator(chunk_size=2000):
+        while current and current[0] < book.pk:
+            current = next(rollup, None)
+
+        rows = list(unrolled.pop(book.pk, []))
+        if current and current[0] == book.pk:
+            rows.extend(current[1])
+            current = next(rollup, None)
+
+        totals = defaultdict(int)
+        items = {}
+        for row in rows:
+            totals[(None, row['month'])] += row['total']
+            if breakdown and row[breakdown]:
+                item = row[breakdown]
+                items[item] = row['{}__title'.format(breakdown)]
+                totals[(item, row['month'])] += row['total']
+
+        book_row = [book.pk, book.title]
+        if breakdown:
+            book_row.append('')
+        yield book_row + [totals.get((None, d), 0) for d in dates]
+
+        for item, title in sorted(items.items()):
+            yield [book.pk, book.title, title] + [
+                totals.get((item, d), 0) for d in dates
+            ]
+
+
+def export_metrics_by_month(books, dates, breakdown=None):
+    """
+    Streams the by-month report as a CSV file.
+    :param books: Book queryset
+    :param dates: list of dates as returned by get_report_months
+    :param breakdown: None, 'format' or 'chapter' to add a row per item
+    :return: StreamingHttpResponse
+    """
+    writer = csv.writer(Echo())
+    response = StreamingHttpResponse(
+        (
+            writer.writerow(row)
+            for row in metrics_by_month_rows(books, dates, breakdown)
+        ),
+        content_type='text/csv',
+    )
+    response['Content-Disposition'] = 'attachment; ' \
+                                      'filename="book_metrics_by_month.csv"'
+
+    return response
+
+
+def get_book_cursor(book):
+    return '{0:%Y-%m-%d}_{1}'.format(book.date_published, book.pk)
+
+
+def parse_book_cursor(cursor):
+    """
+    Splits a cursor from get_book_cursor into its date and pk.
+    :return: tuple of date and int, or None if the cursor is invalid
+    """
+    try:
+        published, pk = cursor.split('_')
+        return datetime.strptime(published, '%Y-%m-%d').date(), int(pk)
+    except (AttributeError, ValueError):
+        return None
+
+
+def keyset_paginate_books(books, page_size, after=None, before=None):
+    """
+    Returns one page of published books, newest first, using keyset
+    pagination on (date_published, pk) so every page costs the same.
+    :param books: Book queryset, all with a date_published
+    :param page_size: int
+    :param after: optional cursor of the last book on the previous page
+    :param before: optional cursor of the first book on the next page
+    :return: tuple of list of books, previous cursor and next cursor
+    """
+    after, before = parse_book_cursor(after), parse_book_cursor(before)
+
+    if before:
+        published, pk = before
+        page = list(
+            books.filter(
+                Q(date_published__gt=published) |
+                Q(date_published=published, pk__gt=pk)
+            ).order_by('date_published', 'pk')[:page_size + 1]
+        )
+        has_previous, has_next = len(page) > page_size, True
+        page = page[:page_size][::-1]
+    else:
+        if after:
+            published, pk = after
+            books = books.filter(
+                Q(date_published__lt=published) |
+                Q(date_published=published, pk__lt=pk)
+            )
+        page = list(
+            books.order_by('-date_published', '-pk')[:page_size + 1]
+        )
+        has_previous, has_next = bool(after), len(page) > page_size
+        page = page[:page_size]
+
+    previous_cursor = next_cursor = None
+    if page and has_previous:
+        previous_cursor = get_book_cursor(page[0])
+    if page and has_next:
+        next_cursor = get_book_cursor(page[-1])
+
+    return page, previous_cursor, next_cursor
+
+
+def get_conditional_validators(last_modified, *parts):
+    """
+    Builds validators for a conditional GET.
+    :param last_modified: aware datetime
+    :param parts: values the response content depends on
+    :return: tuple of quoted ETag and Last-Modified timestamp
+    """
+    etag = quote_etag(
+        md5(
+            ':'.join(str(part) for part in parts).encode('utf-8'),
+        ).hexdigest()
+    )
+    return etag, int(last_modified.timestamp())
+
+
+def set_conditional_headers(response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def parse_since(value):
+    """
+    Parses the since parameter of a delta ONIX export.
+    :param value: str, an ISO 8601 date or date and time
+    :return: aware datetime, or None if the value is invalid
+    """
+    value = value.strip()
+    # An unencoded "+" in a UTC offset arrives as a space.
+    value = re.sub(r'(T\S+) (\d{2}(:?\d{2})?)$', r'\1+\2', value)
+
+    try:
+        since = dateparse.parse_datetime(value)
+        if since is None:
+            day = dateparse.parse_date(value)
+            if day is None:
+                return None
+            since = datetime(day.year, day.month, day.day)
+    except ValueError:
+        return None
+
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+
+    return since
 
 
 def get_chapter_contributor_items(book):
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from plugins.books import files, models
+
+
+class Command(BaseCommand):
+    """
+    Reads and stores the dimensions and MIME type of existing book covers.
+    """
+
+    help = "Stores the width, height and MIME type of book covers that " \
+           "do not have them yet or could not be read before."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Re-read every cover, not just those without metadata.',
+        )
+
+    def handle(self, *args, **options):
+        books = models.Book.objects.exclude(
+            cover='',
+        ).exclude(
+            cover__isnull=True,
+        )
+        if not options.get('all'):
+            books = books.filter(
+                Q(cover_mime_type__isnull=True)
+                | Q(cover_mime_type=files.UNKNOWN_MIME_TYPE),
+            )
+
+        updated = 0
+        for book in books.iterator():
+            book.set_cover_metadata()
+
+            if book.cover_mime_type == files.UNKNOWN_MIME_TYPE:
+                self.stderr.write(
+                    'Could not read the cover of book {0}: {1}'.format(
+                        book.pk,
+                        book.cover.name,
+                    )
+                )
+            else:
+                updated += 1
+
+            models.Book.objects.filter(pk=book.pk).update(
+                cover_width=book.cover_width,
+                cover_height=book.cover_height,
+                cover_mime_type=book.cover_mime_type,
+            )
+
+        self.stdout.write('Stored metadata for {0} covers.'.format(updated))
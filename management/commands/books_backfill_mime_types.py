@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from plugins.books import files, models
+
+
+class Command(BaseCommand):
+    """
+    Detects and stores the MIME type of existing format and chapter files.
+    """
+
+    help = "Detects and stores the MIME type of format and chapter files " \
+           "that do not have one yet, or whose type could not be detected " \
+           "before."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=8,
+            help='Number of files to sniff in parallel.',
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Re-detect every file, not just those without a MIME type.',
+        )
+
+    def handle(self, *args, **options):
+        for model in (models.Format, models.Chapter):
+            objects = model.objects.exclude(filename='')
+            if not options.get('all'):
+                objects = objects.filter(
+                    Q(mime_type__isnull=True)
+                    | Q(mime_type='')
+                    | Q(mime_type=files.UNKNOWN_MIME_TYPE),
+                )
+            objects = list(objects.only('pk', 'filename', 'mime_type'))
+
+            with ThreadPoolExecutor(
+                max_workers=options.get('workers'),
+            ) as executor:
+                mime_types = executor.map(files.detect_mime_type, objects)
+
+                for obj, mime_type in zip(objects, mime_types):
+                    obj.mime_type = mime_type or files.UNKNOWN_MIME_TYPE
+                    if not mime_type:
+                        self.stderr.write(
+                            'File missing for {0} {1}: {2}'.format(
+                                model.__name__,
+                                obj.pk,
+                                obj.filename,
+                            )
+                        )
+
+            model.objects.bulk_update(objects, ['mime_type'], batch_size=500)
+            self.stdout.write(
+                'Stored MIME types for {0} {1} objects.'.format(
+                    len(objects),
+                    model.__name__,
+                )
+            )
@@ -0,0 +1,52 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from plugins.books import logic
+
+
+class Command(BaseCommand):
+    """
+    Folds old BookAccess rows into daily totals and deletes them.
+    """
+
+    help = "Folds book accesses older than the retention period into " \
+           "daily totals, keeping the country and type dimensions, and " \
+           "deletes the raw rows in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--retention-days',
+            type=int,
+            default=getattr(settings, 'BOOKS_ACCESS_RETENTION_DAYS', 365),
+            help='Keep raw accesses for this many days.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=10000,
+            help='Number of raw accesses to compact per transaction.',
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.localtime() - timedelta(
+            days=options.get('retention_days'),
+        )
+        cutoff = cutoff.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        self.stdout.write(
+            'Compacting book accesses before {0}. Only accesses already '
+            'processed by books_rollup_metrics are compacted.'.format(cutoff),
+        )
+        compacted = logic.compact_book_accesses(
+            cutoff,
+            batch_size=options.get('batch_size'),
+            progress=lambda total: self.stdout.write(
+                '{0} accesses compacted so far.'.format(total),
+            ),
+        )
+        self.stdout.write(
+            'Compacted {0} book accesses.'.format(compacted),
+        )
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from press import models as press_models
+from plugins.books import models, onix
+
+
+class Command(BaseCommand):
+    """
+    Writes the full ONIX feed to a gzip file for the export view to serve.
+    """
+
+    help = "Writes the full ONIX feed to files/press/books/onix/onix.xml.gz. " \
+           "The ONIX export serves this file while it is younger than " \
+           "BOOKS_ONIX_FEED_MAX_AGE seconds, so run this more often than " \
+           "that, e.g. from cron."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path',
+            default=None,
+            help='Write the feed here instead of the default location.',
+        )
+
+    def handle(self, *args, **options):
+        press = press_models.Press.objects.first()
+        writer = onix.ONIXWriter(press, press.site_url())
+        path = onix.write_onix_feed(
+            writer,
+            models.Book.objects.all(),
+            path=options.get('path'),
+        )
+
+        self.stdout.write('Wrote the ONIX feed to {0}.'.format(path))
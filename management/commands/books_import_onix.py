@@ -0,0 +1,58 @@
+import gzip
+
+from django.core.management.base import BaseCommand
+
+from plugins.books import onix
+
+
+class Command(BaseCommand):
+    """
+    Imports books from an ONIX 3.0 file.
+    """
+
+    help = "Imports books from an ONIX 3.0 file, which may be gzipped. " \
+           "Products are matched to existing books by ISBN or DOI and " \
+           "updated, otherwise new books are created. Products with " \
+           "NotificationType 05 delete the matching book."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            help='Path to the ONIX file.',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            default=False,
+            help='Check the file and report errors without saving anything.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='Number of products to save per transaction.',
+        )
+
+    def handle(self, *args, **options):
+        path = options.get('path')
+        importer = onix.ONIXImporter(
+            batch_size=options.get('batch_size'),
+            dry_run=options.get('dry_run'),
+            on_error=lambda reference, message: self.stderr.write(
+                '{0}: {1}'.format(reference, message),
+            ),
+        )
+
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as onix_file:
+            counts = importer.run(onix_file)
+
+        self.stdout.write(
+            '{0}{1} created, {2} updated, {3} deleted, {4} failed.'.format(
+                'Dry run: ' if options.get('dry_run') else '',
+                counts['created'],
+                counts['updated'],
+                counts['deleted'],
+                counts['failed'],
+            )
+        )
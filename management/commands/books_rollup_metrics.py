@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from plugins.books import logic
+
+
+class Command(BaseCommand):
+    """
+    Folds new BookAccess rows into the BookAccessMonthly rollup.
+    """
+
+    help = "Folds BookAccess rows recorded since the last run into the " \
+           "monthly rollup used by the by-month metrics report."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=50000,
+            help='Number of BookAccess ids to process per transaction.',
+        )
+        parser.add_argument(
+            '--grace-minutes',
+            type=int,
+            default=None,
+            help='Leave accesses newer than this for the next run, so that '
+                 'rows still being written are not skipped. Defaults to '
+                 'BOOKS_ROLLUP_GRACE_MINUTES, or 10.',
+        )
+
+    def handle(self, *args, **options):
+        processed = logic.rollup_book_accesses(
+            batch_size=options.get('batch_size'),
+            grace_minutes=options.get('grace_minutes'),
+        )
+        self.stdout.write(
+            'Rolled up {0} book accesses.'.format(processed),
+        )
@@ -0,0 +1,39 @@
+# Generated by Django 3.2.20 on 2026-10-18 09:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0030_merge_20190405_1549'),
+        ('books', '0020_auto_20220823_0931'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookAccessRollupState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_access_id', models.PositiveIntegerField(default=0)),
+                ('last_run', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BookAccessMonthly',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(choices=[('download', 'Download'), ('view', 'View')], max_length=20)),
+                ('month', models.DateField(help_text='The first day of the month these accesses fall in.')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='books.book')),
+                ('chapter', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='books.chapter')),
+                ('country', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.country')),
+                ('format', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='books.format')),
+            ],
+            options={
+                'unique_together': {('book', 'format', 'chapter', 'type', 'country', 'month')},
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.20 on 2026-10-18 10:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0021_bookaccessmonthly_bookaccessrollupstate'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bookaccess',
+            index=models.Index(fields=['book', 'type', 'accessed'], name='books_acc_book_type_acc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bookaccess',
+            index=models.Index(fields=['accessed', 'book', 'type'], name='books_acc_accessed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bookaccess',
+            index=models.Index(fields=['identifier', 'book', 'type', 'accessed'], name='books_acc_dedupe_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bookaccessmonthly',
+            index=models.Index(fields=['month', 'book'], name='books_acm_month_book_idx'),
+        ),
+    ]
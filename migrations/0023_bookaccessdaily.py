@@ -0,0 +1,35 @@
+# Generated by Django 3.2.20 on 2026-10-18 10:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0030_merge_20190405_1549'),
+        ('books', '0022_bookaccess_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookAccessDaily',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(choices=[('download', 'Download'), ('view', 'View')], max_length=20)),
+                ('day', models.DateField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='books.book')),
+                ('chapter', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='books.chapter')),
+                ('country', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.country')),
+                ('format', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='books.format')),
+            ],
+            options={
+                'unique_together': {('book', 'format', 'chapter', 'type', 'country', 'day')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='bookaccessdaily',
+            index=models.Index(fields=['day', 'book'], name='books_acd_day_book_idx'),
+        ),
+    ]
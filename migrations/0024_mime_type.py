@@ -0,0 +1,23 @@
+# Generated by Django 3.2.20 on 2026-10-18 11:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0023_bookaccessdaily'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chapter',
+            name='mime_type',
+            field=models.CharField(blank=True, help_text='Detected from the file when it is uploaded.', max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='format',
+            name='mime_type',
+            field=models.CharField(blank=True, help_text='Detected from the file when it is uploaded.', max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.20 on 2026-10-18 11:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0024_mime_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='cover_height',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='cover_mime_type',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='cover_width',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
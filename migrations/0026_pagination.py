@@ -0,0 +1,22 @@
+# Generated by Django 3.2.20 on 2026-10-18 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0025_book_cover_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booksetting',
+            name='books_per_page',
+            field=models.PositiveIntegerField(default=20, help_text='Number of books listed on each page of the books index.'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['date_published', 'id'], name='books_book_published_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.20 on 2026-10-18 13:02
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0026_pagination'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, help_text='Updated when the book or its contributors, formats, chapters or category change.'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='chapter',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, help_text='Updated when the chapter or its contributors change.'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='format',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.20 on 2026-10-18 14:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0027_last_modified'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeletedBook',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('book_id', models.PositiveIntegerField()),
+                ('doi', models.CharField(blank=True, max_length=200, null=True)),
+                ('isbn', models.CharField(blank=True, max_length=30, null=True)),
+                ('title', models.CharField(blank=True, max_length=300)),
+                ('deleted', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['last_modified'], name='books_book_modified_idx'),
+        ),
+    ]
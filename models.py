@@ -1,25 +1,23 @@
 import uuid
 import os
 from mimetypes import guess_type
-from datetime import timedelta
-import magic
 from urllib.parse import urlparse
 
-from user_agents import parse as parse_ua_string
-
 from django.db import models
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete,
+)
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
-from django.core.files.images import get_image_dimensions
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 
-from core import models as core_models
 from core.file_system import JanewayFileSystemStorage
 from core.model_utils import M2MOrderedThroughField
-from metrics.logic import get_iso_country_code
-from utils.shared import get_ip_address
-from plugins.books import files
+from plugins.books import access, files, page_cache
 
 
 fs = JanewayFileSystemStorage()
@@ -40,6 +38,10 @@ class BookSetting(models.Model):
         max_length=255,
         default="Published Books",
     )
+    books_per_page = models.PositiveIntegerField(
+        default=20,
+        help_text="Number of books listed on each page of the books index.",
+    )
 
     def save(self, *args, **kwargs):
         if not self.pk and BookSetting.objects.exists():
@@ -105,6 +107,22 @@ class Book(models.Model):
     publisher_name = models.CharField(max_length=100)
     publisher_loc = models.CharField(max_length=100, verbose_name='Publisher location')
     cover = models.FileField(upload_to=cover_images_upload_path, null=True, blank=True, storage=fs)
+    cover_width = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        editable=False,
+    )
+    cover_height = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        editable=False,
+    )
+    cover_mime_type = models.CharField(
+        max_length=255,
+        blank=True,
+        null=True,
+        editable=False,
+    )
 
     doi = models.CharField(max_length=200, blank=True, null=True, verbose_name='DOI', help_text='10.xxx/1234')
     isbn = models.CharField(max_length=30, blank=True, null=True, verbose_name='ISBN')
@@ -148,10 +166,51 @@ class Book(models.Model):
         help_text="Custom 'how to cite' text. To be used only if the block"
             " generated by Janeway is not suitable.",
     )
+    last_modified = models.DateTimeField(
+        auto_now=True,
+        help_text='Updated when the book or its contributors, formats, '
+                  'chapters or category change.',
+    )
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the books index.
+            models.Index(
+                fields=['date_published', 'id'],
+                name='books_book_published_idx',
+            ),
+            # Delta ONIX exports of books changed since a given time.
+            models.Index(
+                fields=['last_modified'],
+                name='books_book_modified_idx',
+            ),
+        ]
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        if not self.cover:
+            self.cover_width = self.cover_height = None
+            self.cover_mime_type = None
+        elif not self.cover._committed or self.cover_mime_type is None:
+            self.set_cover_metadata()
+
+        return super(Book, self).save(*args, **kwargs)
+
+    def set_cover_metadata(self):
+        (
+            self.cover_width,
+            self.cover_height,
+            self.cover_mime_type,
+        ) = files.get_cover_metadata(self.cover)
+        # Store a fallback when the cover cannot be read so that it is not
+        # read again on every save.
+        self.cover_mime_type = self.cover_mime_type or files.UNKNOWN_MIME_TYPE
+
+        if self.cover._committed:
+            self.cover.close()
+
     @property
     def citation(self):
         return (
@@ -222,29 +281,42 @@ class Book(models.Model):
             'image/png': 'D503',
             'image/tiff': 'D504'
         }
-        return mapping.get(guess_type(self.cover.url)[0], 'D502')
-
-    def cover_height(self):
-        width, height = get_image_dimensions(self.cover)
-        return height
-
-    def cover_width(self):
-        width, height = get_image_dimensions(self.cover)
-        return width
+        mime_type = self.cover_mime_type
+        if mime_type in (None, files.UNKNOWN_MIME_TYPE):
+            mime_type = guess_type(self.cover.url)[0]
+        return mapping.get(mime_type, 'D502')
+
+    def metrics_querysets(self):
+        """
+        Returns the view and download totals that metrics adds up, from
+        BookAccess and BookAccessDaily, each grouped by book.
+        """
+        return [
+            BookAccess.objects.filter(
+                book=self,
+            ).values('book').annotate(
+                views=models.Count('pk', filter=models.Q(type='view')),
+                downloads=models.Count('pk', filter=models.Q(type='download')),
+            ).order_by(),
+            BookAccessDaily.objects.filter(
+                book=self,
+            ).values('book').annotate(
+                views=models.Sum('count', filter=models.Q(type='view')),
+                downloads=models.Sum('count', filter=models.Q(type='download')),
+            ).order_by(),
+        ]
 
     def metrics(self):
-        all_metrics = BookAccess.objects.filter(
-            book=self,
-        )
+        metrics = {'views': 0, 'downloads': 0}
 
-        views = all_metrics.filter(type='view')
-        downloads = all_metrics.filter(type='download')
+        for rows in self.metrics_querysets():
+            for row in rows:
+                for key in ('views', 'downloads'):
+                    metrics[key] += row[key] or 0
 
-        return {
-            'total': all_metrics.count(),
-            'views': views.count(),
-            'downloads': downloads.count(),
-        }
+        metrics['total'] = metrics['views'] + metrics['downloads']
+
+        return metrics
 
     def remote_book_label(self):
         if self.remote_label:
@@ -282,6 +354,10 @@ class Contributor(models.Model):
             return '{middle_initial}.'.format(middle_initial=self.middle_name[0])
 
     def citation_name(self):
+        # Organisations and single-name contributors have no first name.
+        if not self.first_name:
+            return self.last_name
+
         return '{last_name} {first_initial}.'.format(
             last_name=self.last_name,
             first_initial=self.first_name[0],
@@ -296,7 +372,14 @@ class Format(models.Model):
 
     title = models.CharField(max_length=100)
     filename = models.CharField(max_length=100)
+    mime_type = models.CharField(
+        max_length=255,
+        blank=True,
+        null=True,
+        help_text='Detected from the file when it is uploaded.',
+    )
     sequence = models.PositiveIntegerField(default=10)
+    last_modified = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ('sequence',)
@@ -304,48 +387,26 @@ class Format(models.Model):
     def __str__(self):
         return self.title
 
+    def get_mime_type(self):
+        if not self.mime_type:
+            # Store a fallback when detection fails so that a missing file
+            # is not sniffed and saved again on every page view.
+            self.mime_type = (
+                files.detect_mime_type(self) or files.UNKNOWN_MIME_TYPE
+            )
+            Format.objects.filter(pk=self.pk).update(mime_type=self.mime_type)
+        return self.mime_type
+
     def is_epub(self):
-        mime = magic.from_file(files.get_file_path(self), mime=True)
-        if mime == 'application/epub+zip':
-            return True
+        return self.get_mime_type() == files.EPUB_MIME_TYPE
 
     def add_book_access(self, request, access_type='download'):
-        try:
-            user_agent = parse_ua_string(request.META.get('HTTP_USER_AGENT', None))
-        except TypeError:
-            user_agent = None
-
-        ip = get_ip_address(request)
-        iso_country_code = get_iso_country_code(ip)
-        identifier = request.session.session_key
-
-        try:
-            country = core_models.Country.objects.get(
-                code=iso_country_code,
-            )
-        except core_models.Country.DoesNotExist:
-            country = None
-
-        if user_agent and not user_agent.is_bot:
-
-            # check if the current IP has accessed this article recently.
-            time_to_check = timezone.now() - timedelta(seconds=10)
-            check = BookAccess.objects.filter(
-                book=self.book,
-                format=self,
-                accessed__gte=time_to_check,
-                type=access_type,
-                identifier=identifier,
-            ).count()
-
-            if not check:
-                BookAccess.objects.create(
-                    book=self.book,
-                    format=self,
-                    type=access_type,
-                    country=country,
-                    identifier=identifier,
-                )
+        access.record_book_access(
+            request,
+            self.book,
+            access_type,
+            format=self,
+        )
 
 
 def access_choices():
@@ -382,6 +443,25 @@ class BookAccess(models.Model):
     )
     identifier = models.CharField(max_length=100)
 
+    class Meta:
+        indexes = [
+            # Per-book totals and date ranges (Book.metrics, reports).
+            models.Index(
+                fields=['book', 'type', 'accessed'],
+                name='books_acc_book_type_acc_idx',
+            ),
+            # Catalogue-wide date ranges (logic.book_metrics_data).
+            models.Index(
+                fields=['accessed', 'book', 'type'],
+                name='books_acc_accessed_idx',
+            ),
+            # Repeat-access check when no cache is available.
+            models.Index(
+                fields=['identifier', 'book', 'type', 'accessed'],
+                name='books_acc_dedupe_idx',
+            ),
+        ]
+
     def __str__(self):
         return '[{0}] - {1} at {2}'.format(
             self.format,
@@ -390,6 +470,141 @@ class BookAccess(models.Model):
         )
 
 
+class BookAccessMonthly(models.Model):
+    """
+    Monthly rollup of BookAccess rows, maintained by the
+    books_rollup_metrics management command.
+    """
+    book = models.ForeignKey(
+        Book,
+        on_delete=models.CASCADE,
+    )
+    format = models.ForeignKey(
+        Format,
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL,
+    )
+    chapter = models.ForeignKey(
+        'Chapter',
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL,
+    )
+    type = models.CharField(max_length=20, choices=access_choices())
+    country = models.ForeignKey(
+        'core.Country',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+    )
+    month = models.DateField(
+        help_text='The first day of the month these accesses fall in.',
+    )
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (
+            'book', 'format', 'chapter', 'type', 'country', 'month',
+        )
+        indexes = [
+            models.Index(
+                fields=['month', 'book'],
+                name='books_acm_month_book_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return '{0} {1}s of {2} in {3:%Y-%m}'.format(
+            self.count,
+            self.type,
+            self.book.title,
+            self.month,
+        )
+
+
+class BookAccessDaily(models.Model):
+    """
+    Daily totals of BookAccess rows that have been compacted by the
+    books_compact_accesses management command.
+    """
+    book = models.ForeignKey(
+        Book,
+        on_delete=models.CASCADE,
+    )
+    format = models.ForeignKey(
+        Format,
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL,
+    )
+    chapter = models.ForeignKey(
+        'Chapter',
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL,
+    )
+    type = models.CharField(max_length=20, choices=access_choices())
+    country = models.ForeignKey(
+        'core.Country',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+    )
+    day = models.DateField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (
+            'book', 'format', 'chapter', 'type', 'country', 'day',
+        )
+        indexes = [
+            models.Index(
+                fields=['day', 'book'],
+                name='books_acd_day_book_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return '{0} {1}s of {2} on {3:%Y-%m-%d}'.format(
+            self.count,
+            self.type,
+            self.book.title,
+            self.day,
+        )
+
+
+class BookAccessRollupState(models.Model):
+    """
+    Records the high-water mark of BookAccess rows that have been folded
+    into BookAccessMonthly. There is only ever one instance.
+    """
+    last_access_id = models.PositiveIntegerField(default=0)
+    last_run = models.DateTimeField(blank=True, null=True)
+
+    def save(self, *args, **kwargs):
+        if not self.pk and BookAccessRollupState.objects.exists():
+            raise ValidationError(
+                'There can be only one BookAccessRollupState instance'
+            )
+        return super(BookAccessRollupState, self).save(*args, **kwargs)
+
+
+class DeletedBook(models.Model):
+    """
+    A record of a deleted book, kept so that delta ONIX exports can notify
+    recipients of the deletion.
+    """
+    book_id = models.PositiveIntegerField()
+    doi = models.CharField(max_length=200, blank=True, null=True)
+    isbn = models.CharField(max_length=30, blank=True, null=True)
+    title = models.CharField(max_length=300, blank=True)
+    deleted = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return '{0} deleted {1}'.format(self.title, self.deleted)
+
+
 class Chapter(models.Model):
     book = models.ForeignKey(
         Book,
@@ -432,6 +647,12 @@ class Chapter(models.Model):
     filename = models.CharField(
         max_length=255,
     )
+    mime_type = models.CharField(
+        max_length=255,
+        blank=True,
+        null=True,
+        help_text='Detected from the file when it is uploaded.',
+    )
     license_information = models.TextField(
         blank=True,
         null=True,
@@ -455,6 +676,10 @@ class Chapter(models.Model):
         help_text="Custom 'how to cite' text. To be used only if the block"
                   " generated by Janeway is not suitable.",
     )
+    last_modified = models.DateTimeField(
+        auto_now=True,
+        help_text='Updated when the chapter or its contributors change.',
+    )
 
     class Meta:
         ordering = ('sequence', 'number',)
@@ -467,42 +692,12 @@ class Chapter(models.Model):
         )
 
     def add_book_access(self, request, access_type='download'):
-        try:
-            user_agent = parse_ua_string(request.META.get('HTTP_USER_AGENT', None))
-        except TypeError:
-            user_agent = None
-
-        ip = get_ip_address(request)
-        iso_country_code = get_iso_country_code(ip)
-        identifier = request.session.session_key
-
-        try:
-            country = core_models.Country.objects.get(
-                code=iso_country_code,
-            )
-        except core_models.Country.DoesNotExist:
-            country = None
-
-        if user_agent and not user_agent.is_bot:
-
-            # check if the current IP has accessed this article recently.
-            time_to_check = timezone.now() - timedelta(seconds=10)
-            check = BookAccess.objects.filter(
-                book=self.book,
-                chapter=self,
-                accessed__gte=time_to_check,
-                type=access_type,
-                identifier=identifier,
-            ).count()
-
-            if not check:
-                BookAccess.objects.create(
-                    book=self.book,
-                    chapter=self,
-                    type=access_type,
-                    country=country,
-                    identifier=identifier,
-                )
+        access.record_book_access(
+            request,
+            self.book,
+            access_type,
+            chapter=self,
+        )
 
     @property
     def citation(self):
@@ -578,3 +773,63 @@ class KeywordChapter(models.Model):
 
 class PublisherNote(models.Model):
     note = models.TextField(blank=True, null=True)
+
+
+def touch_book(book_id):
+    Book.objects.filter(pk=book_id).update(last_modified=timezone.now())
+
+
+def book_content_changed(sender, instance, **kwargs):
+    """
+    Keeps last_modified current on books and chapters when related objects
+    change, and invalidates cached pages showing the changed object.
+    """
+    if isinstance(instance, Book):
+        if kwargs.get('action'):
+            touch_book(instance.pk)
+        elif kwargs.get('signal') is post_delete:
+            DeletedBook.objects.create(
+                book_id=instance.pk,
+                doi=instance.doi,
+                isbn=instance.isbn,
+                title=instance.title,
+            )
+        page_cache.invalidate_book(instance.pk)
+    elif isinstance(instance, (Chapter, Contributor, Format)):
+        if isinstance(instance, Contributor):
+            Chapter.objects.filter(
+                contributors=instance,
+            ).update(
+                last_modified=timezone.now(),
+            )
+        elif isinstance(instance, Chapter) and kwargs.get('action'):
+            Chapter.objects.filter(
+                pk=instance.pk,
+            ).update(
+                last_modified=timezone.now(),
+            )
+        touch_book(instance.book_id)
+        page_cache.invalidate_book(instance.book_id)
+    else:
+        if isinstance(instance, Category):
+            Book.objects.filter(
+                category=instance,
+            ).update(
+                last_modified=timezone.now(),
+            )
+        page_cache.invalidate_site()
+
+
+for content_model in (Book, Chapter, Contributor, Format, Category, BookSetting):
+    post_save.connect(book_content_changed, sender=content_model)
+    post_delete.connect(book_content_changed, sender=content_model)
+
+# Books lose their category before post_delete is sent.
+pre_delete.connect(book_content_changed, sender=Category)
+
+for through_model in (
+    Book.publisher_notes.through,
+    Chapter.contributors.through,
+    Chapter.publisher_notes.through,
+):
+    m2m_changed.connect(book_content_changed, sender=through_model)
@@ -0,0 +1,785 @@
+"""
+Writes and reads ONIX 3.0 messages.
+
+The message is rendered in three parts, books/onix_header.xml, one
+books/onix_product.xml per book and books/onix_footer.xml, which together
+produce the same output as books/onix.xml. Books are fetched in chunks of
+BOOKS_ONIX_CHUNK_SIZE ordered by pk, so memory use does not grow with the
+size of the catalogue.
+
+Delta exports list the books changed since a given time. Books that have
+since been unpublished, and those deleted (see DeletedBook), are sent as
+books/onix_deletion.xml records with NotificationType 05.
+
+write_onix_feed saves a complete message as a gzip file, which the export
+view serves in place of a live export while it is fresh, see
+books_generate_onix_feed.
+
+Rendered products are cached in the BOOKS_ONIX_CACHE cache (default
+"default") for BOOKS_ONIX_CACHE_TIMEOUT seconds, a day unless set, with 0
+turning the cache off. Keys include each book's last_modified, which the
+signal handlers in models.py bump whenever a book, its cover, contributors,
+formats or chapters change, so an export only renders changed products.
+
+ONIXImporter reads messages with iterparse, one product at a time, and
+upserts them as Books matched by ISBN or DOI, see books_import_onix.
+"""
+import gzip
+import os
+import re
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+from hashlib import md5
+from xml.etree import ElementTree
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError, transaction
+from django.db.models import Q, Value, prefetch_related_objects
+from django.db.models.functions import Replace, Upper
+from django.http import StreamingHttpResponse
+from django.template import Context, RequestContext
+from django.template.loader import get_template
+from django.utils.text import slugify
+
+from plugins.books import files, models
+
+HEADER_TEMPLATE = 'books/onix_header.xml'
+PRODUCT_TEMPLATE = 'books/onix_product.xml'
+FOOTER_TEMPLATE = 'books/onix_footer.xml'
+DELETION_TEMPLATE = 'books/onix_deletion.xml'
+ACCEPTS_GZIP = re.compile(r'\bgzip\b')
+ISBN_SEPARATORS = re.compile(r'[\s-]')
+# Change this when books/onix_product.xml changes to discard cached products.
+PRODUCT_CACHE_VERSION = 2
+
+
+def get_chunk_size():
+    return getattr(settings, 'BOOKS_ONIX_CHUNK_SIZE', 100)
+
+
+def get_cache_timeout():
+    return getattr(settings, 'BOOKS_ONIX_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def get_cache():
+    if not get_cache_timeout():
+        return None
+    return caches[getattr(settings, 'BOOKS_ONIX_CACHE', 'default')]
+
+
+def iter_book_chunks(books, chunk_size=None):
+    """
+    Yields lists of books in pk order, fetching chunk_size at a time.
+    :param books: Book queryset
+    :param chunk_size: int, defaults to BOOKS_ONIX_CHUNK_SIZE
+    """
+    chunk_size = chunk_size or get_chunk_size()
+    books = books.order_by('pk')
+    last_pk = None
+
+    while True:
+        chunk = books
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+
+        if not chunk:
+            return
+
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+class ONIXWriter(object):
+    """
+    Renders an ONIX message piece by piece. Context processors run once,
+    when the writer is created, rather than for every product. Outside of a
+    request, the templates are given the press and its URL directly.
+    """
+
+    def __init__(self, press, press_base_url, request=None):
+        """
+        :param press: Press object
+        :param press_base_url: str URL of the press, without a trailing slash
+        :param request: optional HttpRequest to render with
+        """
+        self.press = press
+        self.header = get_template(HEADER_TEMPLATE).template
+        self.product = get_template(PRODUCT_TEMPLATE).template
+        self.footer = get_template(FOOTER_TEMPLATE).template
+        self.deletion = get_template(DELETION_TEMPLATE).template
+        if request is not None:
+            self.context = RequestContext(request)
+        else:
+            self.context = Context(
+                {
+                    'press': press,
+                    'request': {
+                        'press': press,
+                        'press_base_url': press_base_url,
+                    },
+                }
+            )
+        self.cache = get_cache()
+        # Products also show the press name and URL.
+        self.press_version = md5(
+            '|'.join([press.name, press_base_url]).encode('utf-8')
+        ).hexdigest()
+
+    def get_product_key(self, book):
+        return 'books:onix:product:{0}:{1}:{2}:{3}:{4}'.format(
+            PRODUCT_CACHE_VERSION,
+            self.press.pk,
+            book.pk,
+            book.last_modified.timestamp(),
+            self.press_version,
+        )
+
+    def render_product(self, book):
+        with self.context.push(book=book):
+            return self.product.render(self.context)
+
+    def render_deletion(self, record_id, doi, isbn):
+        with self.context.push(record_id=record_id, doi=doi, isbn=isbn):
+            return self.deletion.render(self.context)
+
+    def render_products(self, books):
+        """
+        Renders a list of books, reusing cached products where possible.
+        Contributors are only fetched for books that have to be rendered.
+        :param books: list of Book objects
+        :return: list of str
+        """
+        if self.cache is None:
+            prefetch_related_objects(books, 'contributor_set')
+            return [self.render_product(book) for book in books]
+
+        keys = [self.get_product_key(book) for book in books]
+        products = self.cache.get_many(keys)
+        missing = [
+            book for book, key in zip(books, keys) if key not in products
+        ]
+
+        if missing:
+            prefetch_related_objects(missing, 'contributor_set')
+            rendered = {
+                self.get_product_key(book): self.render_product(book)
+                for book in missing
+            }
+            self.cache.set_many(rendered, get_cache_timeout())
+            products.update(rendered)
+
+        return [products[key] for key in keys]
+
+    def write(self, book_chunks, deletions=()):
+        """
+        Yields the message as a series of strings.
+        :param book_chunks: iterable of lists of Book objects
+        :param deletions: iterable of (record id, DOI, ISBN) tuples
+        """
+        with self.context.bind_template(self.header):
+            yield self.header.render(self.context)
+            for books in book_chunks:
+                yield from self.render_products(books)
+            for record_id, doi, isbn in deletions:
+                yield self.render_deletion(record_id, doi, isbn)
+            yield self.footer.render(self.context)
+
+
+def iter_deletions(books, deleted_books, since):
+    """
+    Yields deletion records for books unpublished or deleted after since.
+    :param books: Book queryset
+    :param deleted_books: DeletedBook queryset
+    :param since: aware datetime
+    """
+    yield from books.filter(
+        last_modified__gt=since,
+        date_published__isnull=True,
+    ).order_by('pk').values_list('pk', 'doi', 'isbn').iterator()
+
+    yield from deleted_books.filter(
+        deleted__gt=since,
+    ).order_by('pk').values_list(
+        'book_id',
+        'doi',
+        'isbn',
+    ).iterator()
+
+
+def stream_onix_xml(request, books, since=None, deleted_books=None):
+    """
+    Returns a StreamingHttpResponse of an ONIX message for a Book queryset.
+    :param since: optional aware datetime, limiting the message to books
+    changed after it
+    :param deleted_books: DeletedBook queryset to notify deletions from
+    when since is given
+    """
+    writer = ONIXWriter(
+        request.press,
+        request.press_base_url,
+        request=request,
+    )
+    deletions = ()
+
+    if since is not None:
+        deletions = iter_deletions(
+            books,
+            deleted_books if deleted_books is not None
+            else models.DeletedBook.objects.all(),
+            since,
+        )
+        books = books.filter(
+            last_modified__gt=since,
+            date_published__isnull=False,
+        )
+
+    return StreamingHttpResponse(
+        writer.write(iter_book_chunks(books), deletions),
+        content_type='application/xml; charset=utf-8',
+    )
+
+
+def write_onix_feed(writer, books, path=None):
+    """
+    Writes a complete ONIX message to a gzip file. The message is written
+    to a temporary file in the same directory that then replaces the feed,
+    so readers never see a partial file.
+    :param writer: ONIXWriter
+    :param books: Book queryset
+    :param path: str, defaults to files.get_onix_feed_path()
+    :return: str path of the feed
+    """
+    path = path or files.get_onix_feed_path()
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    started = time.time()
+
+    temp = tempfile.NamedTemporaryFile(
+        dir=directory,
+        prefix='.onix-',
+        suffix='.tmp',
+        delete=False,
+    )
+    try:
+        with temp:
+            with gzip.GzipFile(fileobj=temp, mode='wb') as feed:
+                for part in writer.write(iter_book_chunks(books)):
+                    feed.write(part.encode('utf-8'))
+            temp.flush()
+            os.fsync(temp.fileno())
+        os.chmod(temp.name, 0o644)
+        # Date the feed from when it was started, so books changed while it
+        # was being written make it stale, see get_fresh_onix_feed.
+        os.utime(temp.name, (started, started))
+        os.replace(temp.name, path)
+    except BaseException:
+        os.unlink(temp.name)
+        raise
+
+    return path
+
+
+def get_fresh_onix_feed(request):
+    """
+    Finds a pre-generated feed that can be sent to the client: one younger
+    than BOOKS_ONIX_FEED_MAX_AGE seconds, with no books changed or deleted
+    since it was generated, to a client that accepts gzip.
+    :return: tuple of path and os.stat_result, or None
+    """
+    if not ACCEPTS_GZIP.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+        return None
+
+    path = files.get_onix_feed_path()
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    max_age = getattr(settings, 'BOOKS_ONIX_FEED_MAX_AGE', 60 * 60 * 24)
+    if time.time() - stat.st_mtime > max_age:
+        return None
+
+    generated = datetime.fromtimestamp(stat.st_mtime).astimezone()
+    if (
+        models.Book.objects.filter(last_modified__gt=generated).exists()
+        or models.DeletedBook.objects.filter(deleted__gt=generated).exists()
+    ):
+        return None
+
+    return path, stat
+
+
+class ONIXImportError(Exception):
+    pass
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def iter_products(source):
+    """
+    Yields each <Product> element of an ONIX 3.0 message, using reference
+    tag names, as it is parsed. Namespaces are stripped from tags and the
+    document is cleared after each product, so memory use stays flat.
+    :param source: path or binary file object
+    """
+    root = None
+
+    for event, element in ElementTree.iterparse(
+        source,
+        events=('start', 'end'),
+    ):
+        if event == 'start':
+            if root is None:
+                root = element
+            continue
+
+        element.tag = local_name(element.tag)
+        if element.tag == 'Product':
+            yield element
+            root.clear()
+
+
+def find_text(element, path):
+    text = element.findtext(path)
+    # Codes in books/onix_product.xml are followed by zero-width spaces.
+    return text.replace('\u200b', '').strip() if text else None
+
+
+def inner_xml(element):
+    """
+    Returns an element's content, keeping embedded XHTML markup.
+    """
+    return (element.text or '') + ''.join(
+        ElementTree.tostring(child, encoding='unicode')
+        for child in element
+    )
+
+
+def parse_onix_date(element):
+    """
+    Reads an ONIX <Date>, supporting the YYYYMMDD, YYYYMM and YYYY formats.
+    """
+    if element is None or not element.text:
+        return None
+
+    date_format = element.get('dateformat') or '00'
+    value = element.text.strip()
+    formats = {'00': ('%Y%m%d', 8), '01': ('%Y%m', 6), '05': ('%Y', 4)}
+
+    if date_format not in formats:
+        return None
+
+    try:
+        format_string, length = formats[date_format]
+        return datetime.strptime(value[:length], format_string).date()
+    except ValueError:
+        return None
+
+
+def parse_contributor(element, sequence):
+    first_name = find_text(element, 'NamesBeforeKey')
+    biography = element.find('BiographicalNote')
+    last_name = find_text(element, 'KeyNames')
+
+    if not last_name:
+        name = find_text(element, 'PersonName')
+        if name:
+            first_name, _, last_name = name.rpartition(' ')
+        else:
+            last_name = find_text(element, 'CorporateName')
+
+    if not last_name:
+        raise ONIXImportError('Contributor {0} has no name.'.format(sequence))
+
+    try:
+        sequence = int(find_text(element, 'SequenceNumber') or sequence)
+    except ValueError:
+        pass
+
+    return {
+        'first_name': first_name or '',
+        'last_name': last_name,
+        'affiliation': inner_xml(biography).strip().rstrip('\u200b')
+        if biography is not None else '',
+        'sequence': sequence,
+    }
+
+
+def normalise_isbn(isbn):
+    """
+    Removes the hyphens and spaces that ISBNs are often written with.
+    """
+    if not isbn:
+        return isbn
+    return ISBN_SEPARATORS.sub('', isbn).upper()
+
+
+def parse_product(element):
+    """
+    Maps an ONIX 3.0 <Product> to Book, Contributor and Category values.
+    :param element: Product Element with namespaces stripped
+    :return: dict
+    :raises ONIXImportError: if the product cannot be imported
+    """
+    product = {
+        'record_reference': find_text(element, 'RecordReference'),
+        'notification_type': find_text(element, 'NotificationType'),
+        'isbn': None,
+        'doi': None,
+    }
+
+    for identifier in element.iterfind('ProductIdentifier'):
+        id_type = find_text(identifier, 'ProductIDType')
+        value = find_text(identifier, 'IDValue')
+        if id_type in ('15', '03') and value:
+            product['isbn'] = normalise_isbn(value)
+        elif id_type == '06' and value:
+            product['doi'] = value
+
+    if not product['isbn'] and not product['doi']:
+        raise ONIXImportError('Product has no ISBN or DOI.')
+
+    if product['notification_type'] == '05':
+        return product
+
+    title = None
+    for title_element in element.iterfind('DescriptiveDetail/TitleDetail'):
+        if find_text(title_element, 'TitleType') in (None, '01'):
+            title = title_element.find('TitleElement')
+            break
+
+    if title is None or not (
+        find_text(title, 'TitleText') or find_text(title, 'TitleWithoutPrefix')
+    ):
+        raise ONIXImportError('Product has no title.')
+
+    product['prefix'] = find_text(title, 'TitlePrefix')
+    product['title'] = (
+        find_text(title, 'TitleWithoutPrefix') or find_text(title, 'TitleText')
+    )
+    product['subtitle'] = find_text(title, 'Subtitle')
+
+    product['contributors'] = [
+        parse_contributor(contributor, sequence)
+        for sequence, contributor in enumerate(
+            element.iterfind('DescriptiveDetail/Contributor'),
+            start=1,
+        )
+    ]
+
+    product['pages'] = None
+    for extent in element.iterfind('DescriptiveDetail/Extent'):
+        if (
+            find_text(extent, 'ExtentType') in ('00', '11')
+            and find_text(extent, 'ExtentUnit') == '03'
+        ):
+            try:
+                product['pages'] = int(find_text(extent, 'ExtentValue'))
+            except (TypeError, ValueError):
+                raise ONIXImportError('Extent value is not a number.')
+            break
+
+    product['category'] = None
+    for subject in element.iterfind('DescriptiveDetail/Subject'):
+        heading = find_text(subject, 'SubjectHeadingText')
+        if heading:
+            product['category'] = heading
+            if subject.find('MainSubject') is not None:
+                break
+
+    product['description'] = None
+    for text_content in element.iterfind('CollateralDetail/TextContent'):
+        if find_text(text_content, 'TextType') in ('02', '03'):
+            text = text_content.find('Text')
+            if text is not None:
+                product['description'] = inner_xml(text).strip()
+            if find_text(text_content, 'TextType') == '03':
+                break
+
+    product['publisher_name'] = find_text(
+        element,
+        'PublishingDetail/Publisher/PublisherName',
+    )
+    if not product['publisher_name']:
+        raise ONIXImportError('Product has no publisher name.')
+
+    product['publisher_loc'] = find_text(
+        element,
+        'PublishingDetail/CityOfPublication',
+    ) or ''
+
+    product['date_published'] = None
+    for publishing_date in element.iterfind('PublishingDetail/PublishingDate'):
+        if find_text(publishing_date, 'PublishingDateRole') == '01':
+            product['date_published'] = parse_onix_date(
+                publishing_date.find('Date'),
+            )
+            break
+
+    return product
+
+
+def check_lengths(instance):
+    for field in instance._meta.concrete_fields:
+        value = getattr(instance, field.attname)
+        if (
+            field.max_length
+            and isinstance(value, str)
+            and len(value) > field.max_length
+        ):
+            raise ONIXImportError(
+                '{0} is longer than {1} characters.'.format(
+                    field.verbose_name,
+                    field.max_length,
+                )
+            )
+
+
+CONTRIBUTOR_FIELDS = ('first_name', 'last_name', 'affiliation', 'sequence')
+
+
+def match_contributors(existing, imported):
+    """
+    Pairs a book's contributors with those of a product, first by name and
+    then by sequence, so that updating a book keeps the emails and chapter
+    links that ONIX does not carry.
+    :param existing: list of the book's Contributor objects
+    :param imported: list of contributor dicts from parse_product
+    :return: tuple of lists of changed, new and leftover Contributors
+    """
+    def name(first_name, last_name):
+        return first_name.strip().lower(), last_name.strip().lower()
+
+    unmatched = list(existing)
+    pairs = [None] * len(imported)
+
+    for i, values in enumerate(imported):
+        key = name(values['first_name'], values['last_name'])
+        for contributor in unmatched:
+            if name(contributor.first_name, contributor.last_name) == key:
+                pairs[i] = contributor
+                unmatched.remove(contributor)
+                break
+
+    for i, values in enumerate(imported):
+        if pairs[i] is not None:
+            continue
+        for contributor in unmatched:
+            if contributor.sequence == values['sequence']:
+                pairs[i] = contributor
+                unmatched.remove(contributor)
+                break
+
+    changed, new = [], []
+    for contributor, values in zip(pairs, imported):
+        if contributor is None:
+            new.append(models.Contributor(**values))
+            continue
+
+        if any(
+            getattr(contributor, field) != values[field]
+            for field in CONTRIBUTOR_FIELDS
+        ):
+            for field in CONTRIBUTOR_FIELDS:
+                setattr(contributor, field, values[field])
+            changed.append(contributor)
+
+    return changed, new, unmatched
+
+
+class ONIXImporter(object):
+    """
+    Imports an ONIX 3.0 message into Books, updating those that share an
+    ISBN or DOI with a product. Products are saved in transactions of
+    batch_size, each in its own savepoint so that one bad product does not
+    stop the rest of its batch. Products with NotificationType 05 delete
+    the matching book.
+
+    In a dry run nothing is written, but products are still parsed and
+    matched against existing books so that errors are reported.
+    """
+    BOOK_FIELDS = (
+        'prefix',
+        'title',
+        'subtitle',
+        'description',
+        'pages',
+        'date_published',
+        'publisher_name',
+        'publisher_loc',
+        'doi',
+        'isbn',
+    )
+
+    def __init__(self, batch_size=100, dry_run=False, on_error=None):
+        """
+        :param batch_size: int, products per transaction
+        :param dry_run: bool, if True nothing is saved
+        :param on_error: callable taking the product's RecordReference (or
+        position) and an error message
+        """
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.on_error = on_error or (lambda reference, message: None)
+        self.counts = Counter()
+        self.categories = {}
+        self.new_categories = {}
+
+    def run(self, source):
+        """
+        :param source: path or binary file object
+        :return: Counter of products created, updated, deleted and failed
+        """
+        batch = []
+
+        try:
+            for position, element in enumerate(iter_products(source), 1):
+                try:
+                    batch.append(parse_product(element))
+                except ONIXImportError as e:
+                    self.error(
+                        find_text(element, 'RecordReference') or position,
+                        str(e),
+                    )
+                    continue
+
+                if len(batch) >= self.batch_size:
+                    self.import_batch(batch)
+                    batch = []
+        except ElementTree.ParseError as e:
+            self.error('document', str(e))
+
+        if batch:
+            self.import_batch(batch)
+
+        return self.counts
+
+    def error(self, reference, message):
+        self.counts['failed'] += 1
+        self.on_error(reference, message)
+
+    def import_batch(self, products):
+        isbns = {product['isbn'] for product in products if product['isbn']}
+        dois = {product['doi'] for product in products if product['doi']}
+        # Stored ISBNs may be hyphenated, so compare them without separators.
+        books = models.Book.objects.annotate(
+            normalised_isbn=Upper(
+                Replace(
+                    Replace('isbn', Value('-'), Value('')),
+                    Value(' '),
+                    Value(''),
+                ),
+            ),
+        ).filter(
+            Q(normalised_isbn__in=isbns) | Q(doi__in=dois),
+        )
+        by_isbn = {
+            normalise_isbn(book.isbn): book for book in books if book.isbn
+        }
+        by_doi = {book.doi: book for book in books if book.doi}
+
+        with transaction.atomic():
+            for product in products:
+                book = (
+                    by_isbn.get(product['isbn']) or by_doi.get(product['doi'])
+                )
+                try:
+                    with transaction.atomic():
+                        book = self.import_product(product, book)
+                except (ONIXImportError, DatabaseError) as e:
+                    # Categories created for this product were rolled back.
+                    self.new_categories.clear()
+                    self.error(product['record_reference'], str(e))
+                    continue
+
+                self.categories.update(self.new_categories)
+                self.new_categories.clear()
+
+                if book is not None and book.isbn:
+                    by_isbn[normalise_isbn(book.isbn)] = book
+                if book is not None and book.doi:
+                    by_doi[book.doi] = book
+
+            if self.dry_run:
+                transaction.set_rollback(True)
+
+    def import_product(self, product, book):
+        """
+        Saves one product.
+        :return: the saved Book, or None if it was deleted
+        """
+        if product['notification_type'] == '05':
+            if book is not None:
+                if not self.dry_run:
+                    book.delete()
+                self.counts['deleted'] += 1
+            return None
+
+        created = book is None
+        if created:
+            book = models.Book()
+
+        for field in self.BOOK_FIELDS:
+            value = product[field]
+            if field == 'isbn' and normalise_isbn(book.isbn) == value:
+                # Keep the ISBN as it was entered, hyphens and all.
+                continue
+            if value is not None or field not in ('doi', 'isbn'):
+                setattr(book, field, value)
+        check_lengths(book)
+
+        existing = [] if created else list(book.contributor_set.all())
+        changed, new, leftover = match_contributors(
+            existing,
+            product['contributors'],
+        )
+        for contributor in changed + new:
+            check_lengths(contributor)
+
+        if product['category']:
+            book.category = self.get_category(product['category'])
+
+        if not self.dry_run:
+            book.save()
+            for contributor in new:
+                contributor.book = book
+            models.Contributor.objects.filter(
+                pk__in=[contributor.pk for contributor in leftover],
+            ).delete()
+            models.Contributor.objects.bulk_update(
+                changed,
+                CONTRIBUTOR_FIELDS,
+            )
+            models.Contributor.objects.bulk_create(new)
+
+        self.counts['created' if created else 'updated'] += 1
+        return book
+
+    def get_category(self, name):
+        """
+        Finds or creates the Category for a subject heading. New categories
+        are only remembered once their product's savepoint has committed,
+        see import_batch.
+        """
+        if not name:
+            return None
+
+        if name in self.categories:
+            return self.categories[name]
+
+        category = models.Category.objects.filter(name=name).first()
+        if category is None and not self.dry_run:
+            category = models.Category(name=name, slug=slugify(name)[:255])
+            check_lengths(category)
+            category.save()
+            self.new_categories[name] = category
+        else:
+            self.categories[name] = category
+
+        return category
@@ -0,0 +1,143 @@
+"""
+An opt-in cache for the rendered public book pages.
+
+Set BOOKS_PAGE_CACHE_TIMEOUT to a number of seconds to cache the output of
+the index, book and chapter views for anonymous GET requests, in the cache
+named by BOOKS_PAGE_CACHE (default "default"). Keys include the press,
+theme and a version for the site as a whole, the listing and each book.
+Versions are replaced by the signal handlers in models.py whenever books or
+their related objects change, so stale entries are never read again and
+simply expire.
+"""
+from functools import wraps
+from hashlib import md5
+from uuid import uuid4
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import caches
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+
+SITE_VERSION_KEY = 'books:page:site'
+INDEX_VERSION_KEY = 'books:page:index'
+BOOK_VERSION_KEY = 'books:page:book:{0}'
+
+
+def get_timeout():
+    return getattr(settings, 'BOOKS_PAGE_CACHE_TIMEOUT', None)
+
+
+def enabled():
+    return bool(get_timeout())
+
+
+def get_cache():
+    return caches[getattr(settings, 'BOOKS_PAGE_CACHE', 'default')]
+
+
+def get_versions(*version_keys):
+    """
+    Returns the current version for each key, creating any that are missing.
+    """
+    cache = get_cache()
+    versions = cache.get_many(version_keys)
+
+    for key in version_keys:
+        if key not in versions:
+            versions[key] = uuid4().hex
+            cache.set(key, versions[key], None)
+
+    return [versions[key] for key in version_keys]
+
+
+def invalidate_site():
+    if not enabled():
+        return
+
+    get_cache().set_many(
+        {
+            SITE_VERSION_KEY: uuid4().hex,
+            INDEX_VERSION_KEY: uuid4().hex,
+        },
+        None,
+    )
+
+
+def invalidate_book(book_id):
+    if not enabled():
+        return
+
+    get_cache().set_many(
+        {
+            INDEX_VERSION_KEY: uuid4().hex,
+            BOOK_VERSION_KEY.format(book_id): uuid4().hex,
+        },
+        None,
+    )
+
+
+def is_cacheable(request):
+    return (
+        enabled()
+        and request.method == 'GET'
+        and not request.user.is_authenticated
+        and not len(get_messages(request))
+    )
+
+
+def cached_page(view_func):
+    """
+    Caches a view's response for anonymous visitors. Views that take a
+    book_id are versioned per book, the rest by the listing version.
+    """
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        if not is_cacheable(request):
+            return view_func(request, *args, **kwargs)
+
+        book_id = kwargs.get('book_id')
+        versions = get_versions(
+            SITE_VERSION_KEY,
+            BOOK_VERSION_KEY.format(book_id) if book_id else INDEX_VERSION_KEY,
+        )
+        key = 'books:page:{0}:{1}:{2}'.format(
+            view_func.__name__,
+            ':'.join(versions),
+            md5(
+                '|'.join(
+                    [
+                        str(request.press.pk),
+                        request.press.theme,
+                        getattr(request, 'LANGUAGE_CODE', ''),
+                        request.get_full_path(),
+                    ]
+                ).encode('utf-8')
+            ).hexdigest(),
+        )
+
+        cache = get_cache()
+        response = cache.get(key)
+        if response is not None:
+            return get_conditional_response(
+                request,
+                etag=response.get('ETag'),
+                last_modified=parse_http_date_safe(
+                    response.get('Last-Modified'),
+                ),
+                response=response,
+            )
+
+        response = view_func(request, *args, **kwargs)
+
+        # Pages that issued a CSRF token or set cookies are per-visitor.
+        if (
+            response.status_code == 200
+            and not request.META.get('CSRF_COOKIE_USED')
+            and not response.cookies
+        ):
+            cache.set(key, response, get_timeout())
+
+        return response
+
+    return wrapper
@@ -0,0 +1,790 @@
+import io
+import os
+import re
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock, skipIf, skipUnless
+from wsgiref.util import FileWrapper
+
+from django.db import connection
+from django.http import StreamingHttpResponse
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from plugins.books import access, files, logic, models, onix
+from utils.testing import helpers
+
+# Plan lines that show BookAccess being read in full rather than through an
+# index, for the databases Janeway supports.
+SEQUENTIAL_SCANS = {
+    'postgresql': re.compile(r'Seq Scan on books_bookaccess\b'),
+    'sqlite': re.compile(r'\bSCAN (TABLE )?books_bookaccess\b(?! USING)'),
+}
+
+run_benchmarks = skipUnless(
+    os.environ.get('BOOKS_BENCHMARKS'),
+    'Set BOOKS_BENCHMARKS=1 to run benchmarks.',
+)
+
+
+def report(title, rows):
+    sys.stderr.write('\n{0}\n'.format(title))
+    for row in rows:
+        sys.stderr.write('  {0}\n'.format(row))
+
+
+def create_book(title='Book', **kwargs):
+    return models.Book.objects.create(
+        title=title,
+        publisher_name='Publisher',
+        publisher_loc='London',
+        date_published=kwargs.pop(
+            'date_published',
+            timezone.now().date() - timedelta(days=1),
+        ),
+        **kwargs
+    )
+
+
+def create_books(count, category=None):
+    """
+    Creates published books, each with a contributor, a format and a view
+    and download of that format.
+    """
+    books = []
+    for i in range(count):
+        book = create_book(title='Book {0}'.format(i), category=category)
+        models.Contributor.objects.create(
+            book=book,
+            first_name='Ann',
+            last_name='Author',
+            affiliation='University',
+        )
+        book_format = models.Format.objects.create(
+            book=book,
+            title='PDF',
+            filename='book-{0}.pdf'.format(i),
+            mime_type='application/pdf',
+        )
+        for access_type in ('view', 'download'):
+            models.BookAccess.objects.create(
+                book=book,
+                format=book_format,
+                type=access_type,
+                identifier='session',
+            )
+        books.append(book)
+    return books
+
+
+class QueryBudgetTestCase(TestCase):
+    """
+    Compares the queries a page makes for small and large catalogues.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.press = helpers.create_press()
+
+    def get(self, url):
+        return self.client.get(url, SERVER_NAME=self.press.domain)
+
+    def count_queries(self, url):
+        # Let per-process caches, e.g. of settings, fill first.
+        self.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assertSameQueries(self, url, expected):
+        self.get(url)
+        with self.assertNumQueries(expected):
+            response = self.get(url)
+        self.assertEqual(response.status_code, 200)
+
+
+@skipIf(
+    connection.vendor not in SEQUENTIAL_SCANS,
+    'Query plans are only checked on PostgreSQL and SQLite.',
+)
+class BookAccessQueryPlanTests(TestCase):
+    """
+    Checks that the reports and the dedupe check can read BookAccess
+    through its indexes.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = create_book()
+        cls.other_book = create_book(title='Other Book')
+        cls.format = models.Format.objects.create(
+            book=cls.book,
+            title='PDF',
+            filename='book.pdf',
+        )
+        now = timezone.now()
+        models.BookAccess.objects.bulk_create(
+            models.BookAccess(
+                book=cls.book if i % 3 else cls.other_book,
+                format=cls.format if i % 2 else None,
+                type='download' if i % 2 else 'view',
+                identifier='session-{0}'.format(i % 50),
+                accessed=now - timedelta(hours=i),
+            ) for i in range(2000)
+        )
+        models.BookAccessRollupState.objects.create(last_access_id=0)
+
+    def setUp(self):
+        if connection.vendor == 'postgresql':
+            # The seeded table is small enough that PostgreSQL would scan
+            # it whatever indexes exist, so ask whether an index can be
+            # used at all.
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+            self.addCleanup(self.reset_seqscan)
+
+    def reset_seqscan(self):
+        with connection.cursor() as cursor:
+            cursor.execute('RESET enable_seqscan')
+
+    def assertUsesIndex(self, queryset):
+        plan = queryset.explain()
+        self.assertIsNone(
+            SEQUENTIAL_SCANS[connection.vendor].search(plan),
+            'Sequential scan of BookAccess:\n{0}'.format(plan),
+        )
+
+    def test_book_metrics_data(self):
+        end = timezone.now()
+        querysets = logic.book_metrics_querysets(
+            models.Book.objects.all(),
+            end - timedelta(days=30),
+            end,
+        )
+
+        for queryset, field in querysets:
+            if queryset.model is models.BookAccess:
+                with self.subTest(field=field):
+                    self.assertUsesIndex(queryset)
+
+    def test_book_metrics(self):
+        accesses, compacted = self.book.metrics_querysets()
+        self.assertUsesIndex(accesses)
+
+    def test_dedupe_check(self):
+        self.assertUsesIndex(
+            access.recent_accesses(
+                self.book.pk,
+                self.format.pk,
+                None,
+                'download',
+                'session-1',
+                timezone.now() - timedelta(seconds=10),
+            ),
+        )
+
+    def test_monthly_unrolled_rows(self):
+        today = timezone.now().date()
+        self.assertUsesIndex(
+            logic.monthly_unrolled_rows(
+                models.Book.objects.all(),
+                logic.get_first_day(today, d_months=-2),
+                logic.get_first_day(today),
+            ),
+        )
+
+
+class CompactBookAccessesTests(TestCase):
+
+    def test_batches_fold_each_access_once(self):
+        book = create_book()
+        models.BookAccess.objects.bulk_create(
+            models.BookAccess(
+                book=book,
+                type='view',
+                identifier='session-{0}'.format(i),
+                accessed=timezone.now() - timedelta(days=400 + i % 3),
+            ) for i in range(25)
+        )
+        last_access = models.BookAccess.objects.order_by('-pk').first()
+        models.BookAccessRollupState.objects.create(
+            last_access_id=last_access.pk,
+        )
+        progress = []
+
+        compacted = logic.compact_book_accesses(
+            timezone.now() - timedelta(days=365),
+            batch_size=10,
+            progress=progress.append,
+        )
+
+        self.assertEqual(compacted, 25)
+        self.assertEqual(progress, [10, 20, 25])
+        self.assertFalse(models.BookAccess.objects.exists())
+        self.assertEqual(
+            sum(
+                models.BookAccessDaily.objects.values_list('count', flat=True)
+            ),
+            25,
+        )
+        self.assertEqual(models.BookAccessDaily.objects.count(), 3)
+
+
+class BookMetricsQueryTests(QueryBudgetTestCase):
+
+    def setUp(self):
+        user = helpers.create_user('staff@example.com')
+        user.is_staff = True
+        user.is_active = True
+        user.save()
+        self.client.force_login(user)
+
+    def test_metrics_queries_do_not_depend_on_catalogue_size(self):
+        url = reverse('books_metrics')
+        create_books(1)
+        expected = self.count_queries(url)
+
+        create_books(10)
+        self.assertSameQueries(url, expected)
+
+    def test_book_metrics_data_totals(self):
+        books = create_books(3)
+        today = timezone.now().date()
+
+        data = logic.book_metrics_data(
+            models.Book.objects.filter(pk__in=[book.pk for book in books]),
+            today - timedelta(days=1),
+            today + timedelta(days=1),
+        )
+
+        self.assertEqual(len(data), 3)
+        for book_data in data:
+            self.assertEqual(book_data['views'], 1)
+            self.assertEqual(book_data['downloads'], 1)
+            self.assertEqual(book_data['formats'][0]['downloads'], 1)
+
+    def test_book_metrics_totals(self):
+        book, = create_books(1)
+        models.BookAccessDaily.objects.create(
+            book=book,
+            type='view',
+            day=timezone.now().date() - timedelta(days=400),
+            count=5,
+        )
+
+        self.assertEqual(
+            book.metrics(),
+            {'views': 6, 'downloads': 1, 'total': 7},
+        )
+        self.assertEqual(
+            create_book(title='Unread').metrics(),
+            {'views': 0, 'downloads': 0, 'total': 0},
+        )
+
+
+class PublicPageQueryTests(QueryBudgetTestCase):
+    themes = ('olh', 'material')
+
+    def set_theme(self, theme):
+        self.press.theme = theme
+        self.press.save()
+
+    def create_chapters(self, book, count):
+        for i in range(count):
+            chapter = models.Chapter.objects.create(
+                book=book,
+                title='Chapter {0}'.format(i),
+                description='',
+                filename='chapter-{0}.pdf'.format(i),
+                sequence=i,
+            )
+            chapter.contributors.add(*book.contributor_set.all())
+
+    def check_index(self, theme):
+        self.set_theme(theme)
+        category = models.Category.objects.create(
+            name='Monographs',
+            slug='monographs-{0}'.format(theme),
+        )
+        url = reverse('books_index')
+        create_books(1, category=category)
+        expected = self.count_queries(url)
+
+        create_books(10, category=category)
+        self.assertSameQueries(url, expected)
+
+    def check_view_book(self, theme):
+        self.set_theme(theme)
+        small_book, large_book = create_books(2)
+        self.create_chapters(small_book, 1)
+
+        for i in range(9):
+            models.Contributor.objects.create(
+                book=large_book,
+                first_name='Contributor',
+                last_name=str(i),
+                affiliation='University',
+            )
+            models.Format.objects.create(
+                book=large_book,
+                title='Format {0}'.format(i),
+                filename='format-{0}.pdf'.format(i),
+                mime_type='application/pdf',
+            )
+        self.create_chapters(large_book, 10)
+
+        expected = self.count_queries(
+            reverse('books_book', kwargs={'book_id': small_book.pk}),
+        )
+        self.assertSameQueries(
+            reverse('books_book', kwargs={'book_id': large_book.pk}),
+            expected,
+        )
+
+    def test_index_queries_do_not_depend_on_page_size(self):
+        for theme in self.themes:
+            with self.subTest(theme=theme):
+                models.Book.objects.all().delete()
+                self.check_index(theme)
+
+    def test_view_book_queries_do_not_depend_on_book_size(self):
+        for theme in self.themes:
+            with self.subTest(theme=theme):
+                self.check_view_book(theme)
+
+
+class ONIXImportTests(TestCase):
+    product = """<?xml version="1.0" encoding="UTF-8"?>
+<ONIXMessage xmlns="http://ns.editeur.org/onix/3.0/reference" release="3.0">
+<Product>
+  <RecordReference>book-1</RecordReference>
+  <NotificationType>03</NotificationType>
+  <ProductIdentifier>
+    <ProductIDType>15</ProductIDType>
+    <IDValue>9781234567897</IDValue>
+  </ProductIdentifier>
+  <DescriptiveDetail>
+    <TitleDetail>
+      <TitleType>01</TitleType>
+      <TitleElement><TitleText>New Title</TitleText></TitleElement>
+    </TitleDetail>
+    {contributors}
+  </DescriptiveDetail>
+  <PublishingDetail>
+    <Publisher><PublisherName>Publisher</PublisherName></Publisher>
+  </PublishingDetail>
+</Product>
+</ONIXMessage>"""
+    contributor = """<Contributor>
+      <SequenceNumber>{0}</SequenceNumber>
+      <NamesBeforeKey>{1}</NamesBeforeKey>
+      <KeyNames>{2}</KeyNames>
+    </Contributor>"""
+
+    def setUp(self):
+        self.book = create_book(isbn='978-1-234-56789-7')
+        self.ann = models.Contributor.objects.create(
+            book=self.book,
+            first_name='Ann',
+            last_name='Author',
+            affiliation='University',
+            email='ann@example.com',
+            sequence=1,
+        )
+        self.bob = models.Contributor.objects.create(
+            book=self.book,
+            first_name='Bob',
+            last_name='Writer',
+            affiliation='University',
+            sequence=2,
+        )
+        self.chapter = models.Chapter.objects.create(
+            book=self.book,
+            title='Chapter',
+            description='',
+            filename='chapter.pdf',
+            sequence=1,
+        )
+        self.chapter.contributors.add(self.ann)
+
+    def import_contributors(self, *names):
+        message = self.product.format(
+            contributors=''.join(
+                self.contributor.format(sequence, first_name, last_name)
+                for sequence, (first_name, last_name) in enumerate(names, 1)
+            ),
+        )
+        return onix.ONIXImporter().run(io.BytesIO(message.encode('utf-8')))
+
+    def test_hyphenated_isbn_is_matched(self):
+        counts = self.import_contributors(('Ann', 'Author'))
+
+        self.assertEqual(counts['updated'], 1)
+        self.assertEqual(counts['created'], 0)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.title, 'New Title')
+        self.assertEqual(self.book.isbn, '978-1-234-56789-7')
+
+    def test_contributors_are_matched_by_name(self):
+        self.import_contributors(('Cat', 'Editor'), ('Ann', 'Author'))
+
+        self.ann.refresh_from_db()
+        self.assertEqual(self.ann.sequence, 2)
+        self.assertEqual(self.ann.email, 'ann@example.com')
+        self.assertEqual(list(self.chapter.contributors.all()), [self.ann])
+        self.assertEqual(
+            [
+                contributor.first_name
+                for contributor in self.book.contributor_set.all()
+            ],
+            ['Cat', 'Ann'],
+        )
+
+    def test_contributors_are_matched_by_sequence(self):
+        self.import_contributors(('Ann', 'Author'), ('Robert', 'Writer'))
+
+        self.bob.refresh_from_db()
+        self.assertEqual(self.bob.first_name, 'Robert')
+        self.assertEqual(self.book.contributor_set.count(), 2)
+
+    def test_missing_contributors_are_created_and_leftovers_deleted(self):
+        self.import_contributors(
+            ('Ann', 'Author'),
+            ('Dan', 'New'),
+            ('Eve', 'Too'),
+        )
+
+        self.assertEqual(
+            [
+                contributor.last_name
+                for contributor in self.book.contributor_set.all()
+            ],
+            ['Author', 'New', 'Too'],
+        )
+        self.assertTrue(
+            models.Contributor.objects.filter(pk=self.ann.pk).exists(),
+        )
+
+        self.import_contributors(('Ann', 'Author'))
+        self.assertEqual(list(self.book.contributor_set.all()), [self.ann])
+
+
+class ONIXFeedTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.press = helpers.create_press()
+
+    def setUp(self):
+        user = helpers.create_user('staff@example.com')
+        user.is_staff = True
+        user.is_active = True
+        user.save()
+        self.client.force_login(user)
+
+        create_books(2)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'onix.xml.gz')
+        patcher = mock.patch.object(
+            files,
+            'get_onix_feed_path',
+            return_value=self.path,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_export(self, **extra):
+        return self.client.get(
+            reverse('books_export_onix_xml'),
+            SERVER_NAME=self.press.domain,
+            **extra
+        )
+
+    def test_feed_has_the_headers_of_the_live_export(self):
+        live = self.get_export()
+        self.assertFalse(live.has_header('Content-Encoding'))
+
+        onix.write_onix_feed(
+            onix.ONIXWriter(self.press, self.press.site_url()),
+            models.Book.objects.all(),
+        )
+        feed = self.get_export(HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(feed['Content-Encoding'], 'gzip')
+        self.assertEqual(feed['Content-Type'], live['Content-Type'])
+        self.assertFalse(feed.has_header('Content-Disposition'))
+        self.assertFalse(live.has_header('Content-Disposition'))
+        feed.close()
+
+
+@override_settings(BOOKS_ACCESS_MAX_QUEUED=5)
+class AccessBufferTests(SimpleTestCase):
+
+    def event(self, i):
+        return access.AccessEvent(
+            book_id=i,
+            format_id=None,
+            chapter_id=None,
+            type='view',
+            identifier='session',
+            ip='127.0.0.1',
+            accessed=timezone.now(),
+        )
+
+    def test_failed_writes_keep_the_newest_events(self):
+        buffer = access.AccessBuffer()
+        buffer.events = [self.event(i) for i in range(4)]
+
+        with mock.patch.object(
+            access,
+            'write_events',
+            side_effect=Exception('Database is down'),
+        ):
+            buffer.flush()
+            self.assertEqual(len(buffer.events), 4)
+
+            buffer.events.extend(self.event(i) for i in range(4, 8))
+            with self.assertLogs(access.logger, 'ERROR'):
+                buffer.flush()
+
+        self.assertEqual(
+            [event.book_id for event in buffer.events],
+            [3, 4, 5, 6, 7],
+        )
+
+
+class BookCoverTests(TestCase):
+
+    def test_unreadable_cover_is_not_read_on_every_save(self):
+        book = create_book()
+        book.cover = 'cover_images/missing.png'
+        book.save()
+
+        self.assertIsNone(book.cover_width)
+        self.assertEqual(book.cover_mime_type, files.UNKNOWN_MIME_TYPE)
+        self.assertEqual(book.cover_onix_code(), 'D503')
+
+        with mock.patch.object(files, 'get_cover_metadata') as read_cover:
+            book.title = 'New Title'
+            book.save()
+        read_cover.assert_not_called()
+
+
+class RangeHeaderTests(SimpleTestCase):
+    size = 1000
+
+    def parse(self, header):
+        return files.parse_range_header(header, self.size)
+
+    def test_no_header(self):
+        self.assertIsNone(self.parse(None))
+        self.assertIsNone(self.parse('items=0-9'))
+
+    def test_open_ended_range(self):
+        self.assertEqual(self.parse('bytes=900-'), [(900, 999)])
+        self.assertEqual(self.parse('bytes=999-'), [(999, 999)])
+
+    def test_open_ended_range_past_end(self):
+        for header in ('bytes=1000-', 'bytes=2000-'):
+            with self.subTest(header=header):
+                with self.assertRaises(files.RangeNotSatisfiable):
+                    self.parse(header)
+
+    def test_range_past_end(self):
+        with self.assertRaises(files.RangeNotSatisfiable):
+            self.parse('bytes=1000-1999')
+        self.assertEqual(self.parse('bytes=0-9,2000-'), [(0, 9)])
+
+    def test_end_clamped_to_size(self):
+        self.assertEqual(self.parse('bytes=900-5000'), [(900, 999)])
+
+    def test_suffix_range(self):
+        self.assertEqual(self.parse('bytes=-200'), [(800, 999)])
+        self.assertEqual(self.parse('bytes=-5000'), [(0, 999)])
+        with self.assertRaises(files.RangeNotSatisfiable):
+            self.parse('bytes=-0')
+
+    def test_malformed_range(self):
+        for header in ('bytes=5-3', 'bytes=a-9', 'bytes=9'):
+            with self.subTest(header=header):
+                self.assertIsNone(self.parse(header))
+
+    def test_ranges_are_coalesced(self):
+        self.assertEqual(
+            self.parse('bytes=20-29,0-9,5-19,100-109'),
+            [(0, 29), (100, 109)],
+        )
+
+    def test_too_many_ranges(self):
+        header = 'bytes=' + ','.join(
+            '{0}-{0}'.format(i * 2) for i in range(files.MAX_RANGES + 1)
+        )
+        self.assertIsNone(self.parse(header))
+
+
+@run_benchmarks
+class UserAgentBenchmark(SimpleTestCase):
+    """
+    Compares access.is_robot_user_agent with parsing every User-Agent with
+    the user_agents package, over traffic where a few hundred distinct
+    strings repeat, as they do in practice.
+    """
+    requests = 50000
+
+    def get_traffic(self):
+        browsers = [
+            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+            '(KHTML, like Gecko) Chrome/{0}.0.0.0 Safari/537.36',
+            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) '
+            'AppleWebKit/605.1.15 (KHTML, like Gecko) Version/{0}.0 '
+            'Safari/605.1.15',
+            'Mozilla/5.0 (X11; Linux x86_64; rv:{0}.0) Gecko/20100101 '
+            'Firefox/{0}.0',
+            'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) '
+            'AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148 '
+            'Version/{0}.0',
+        ]
+        robots = [
+            'Mozilla/5.0 (compatible; Googlebot/{0}.1; '
+            '+http://www.google.com/bot.html)',
+            'python-requests/2.{0}.0',
+            'curl/7.{0}.1',
+        ]
+        distinct = [
+            template.format(version)
+            for template in browsers + robots
+            for version in range(60, 110)
+        ]
+        return [
+            distinct[i * 7919 % len(distinct)] for i in range(self.requests)
+        ]
+
+    def time_classifier(self, classify, traffic):
+        started, cpu_started = time.perf_counter(), time.process_time()
+        for user_agent in traffic:
+            classify(user_agent)
+        return (
+            time.perf_counter() - started,
+            time.process_time() - cpu_started,
+        )
+
+    def test_user_agent_classification(self):
+        try:
+            from user_agents import parse as parse_ua_string
+        except ImportError:
+            self.skipTest('user_agents is not installed.')
+
+        traffic = self.get_traffic()
+        access.reload_robot_patterns()
+
+        parsed = self.time_classifier(
+            lambda user_agent: parse_ua_string(user_agent).is_bot,
+            traffic,
+        )
+        cached = self.time_classifier(access.is_robot_user_agent, traffic)
+
+        report(
+            'User-Agent classification, {0} requests, {1} distinct:'.format(
+                len(traffic),
+                len(set(traffic)),
+            ),
+            [
+                '{0:<28} {1:8.3f}s wall {2:8.3f}s CPU '
+                '{3:8.2f}us/request'.format(
+                    name,
+                    wall,
+                    cpu,
+                    wall / len(traffic) * 1000000,
+                ) for name, (wall, cpu) in (
+                    ('user_agents parse', parsed),
+                    ('is_robot_user_agent', cached),
+                )
+            ] + [
+                'is_robot_user_agent cache: {0}'.format(
+                    access.is_robot_user_agent.cache_info(),
+                ),
+            ],
+        )
+        self.assertLess(cached[0], parsed[0])
+
+
+@run_benchmarks
+class DownloadBenchmark(SimpleTestCase):
+    """
+    Compares files.serve_file with the previous FileWrapper streaming, as
+    a WSGI server without wsgi.file_wrapper would consume them. Servers
+    that provide it send FileResponses with sendfile, which is faster
+    still and cannot be measured here.
+    """
+    size = int(os.environ.get('BOOKS_BENCHMARK_FILE_MB', 256)) * 1024 * 1024
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with tempfile.NamedTemporaryFile(delete=False) as book_file:
+            block = os.urandom(1024 * 1024)
+            for _ in range(cls.size // len(block)):
+                book_file.write(block)
+        cls.path = book_file.name
+
+    @classmethod
+    def tearDownClass(cls):
+        os.unlink(cls.path)
+        super().tearDownClass()
+
+    def consume(self, response):
+        started, cpu_started = time.perf_counter(), time.process_time()
+        sent = sum(len(block) for block in response)
+        response.close()
+        wall = time.perf_counter() - started
+        cpu = time.process_time() - cpu_started
+        self.assertEqual(sent, self.size)
+        return wall, cpu
+
+    def serve_with_file_wrapper(self):
+        return StreamingHttpResponse(
+            FileWrapper(open(self.path, 'rb'), 8192),
+            content_type='application/pdf',
+        )
+
+    def serve_with_block_size(self, block_size):
+        with override_settings(BOOKS_FILE_BLOCK_SIZE=block_size):
+            response = files.serve_file(
+                None,
+                self.path,
+                'book.pdf',
+                'application/pdf',
+            )
+        return response
+
+    def test_download_throughput(self):
+        results = [
+            ('FileWrapper, 8 KiB', self.consume(self.serve_with_file_wrapper())),
+        ]
+        for block_size in (8192, 64 * 1024, 1024 * 1024):
+            response = self.serve_with_block_size(block_size)
+            results.append(
+                (
+                    'FileResponse, {0} KiB'.format(block_size // 1024),
+                    self.consume(response),
+                )
+            )
+            self.assertTrue(response.file_to_stream.closed)
+
+        gigabytes = self.size / 1024 ** 3
+        report(
+            'Downloading a {0} MiB file:'.format(self.size // 1024 ** 2),
+            [
+                '{0:<22} {1:8.1f} MiB/s {2:8.3f}s CPU/GiB'.format(
+                    name,
+                    self.size / 1024 ** 2 / wall,
+                    cpu / gigabytes,
+                ) for name, (wall, cpu) in results
+            ],
+        )
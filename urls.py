@@ -6,9 +6,14 @@ urlpatterns = [
     re_path(r'^$', views.index, name='books_index'),
     re_path(r'^category/(?P<category_slug>[-\w.]+)/$', views.index, name='books_index_category'),
     re_path(r'^(?P<book_id>\d+)/$', views.view_book, name='books_book'),
+    re_path(r'^(?P<book_id>\d+)/metrics/$', views.book_metrics_json, name='books_book_metrics'),
     re_path(r'^(?P<book_id>\d+)/format/(?P<format_id>\d+)/$', views.download_format, name='books_download_format'),
     re_path(r'^(?P<book_id>\d+)/format/(?P<format_id>\d+)/mark_download/(?P<mark_download>no|yes)/$', views.download_format, name='books_download_format'),
     re_path(r'^(?P<book_id>\d+)/format/(?P<format_id>\d+)/read/$', views.read_epub, name='books_read_epub'),
+    re_path(r'^(?P<book_id>\d+)/format/(?P<format_id>\d+)/read/files/$', views.read_epub_entry,
+        name='books_read_epub_files'),
+    re_path(r'^(?P<book_id>\d+)/format/(?P<format_id>\d+)/read/files/(?P<entry>.+)$', views.read_epub_entry,
+        name='books_read_epub_entry'),
     re_path(r'^(?P<book_id>\d+)/chapter/(?P<chapter_id>\d+)$',
         views.view_chapter,
         name='book_view_chapter'),
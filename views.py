@@ -1,26 +1,52 @@
 import csv
-import magic
+from datetime import datetime
 
+from django.conf import settings
 from django.shortcuts import render, get_object_or_404, redirect, HttpResponse
 from django.urls import reverse
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
-from django.http import Http404
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponseBadRequest,
+    JsonResponse,
+)
 from django.db.models import Q
 from django.utils import timezone
-
-from plugins.books import models, forms, files, logic
+from django.utils.cache import (
+    get_conditional_response,
+    patch_cache_control,
+    patch_vary_headers,
+)
+
+from plugins.books import (
+    access,
+    epub,
+    models,
+    forms,
+    files,
+    logic,
+    onix,
+    page_cache,
+)
 from core import files as core_files
 from utils import setting_handler
 
 
+@page_cache.cached_page
 def index(request, category_slug=None):
     category = None
     today = timezone.now().date()
     books = models.Book.objects.filter(
         Q(date_published__lte=today) &
         (Q(date_embargo__isnull=True) | Q(date_embargo__lte=today))
-    ).order_by('-date_published')
+    ).select_related(
+        'category',
+    ).prefetch_related(
+        'contributor_set',
+        'format_set',
+    )
 
     if category_slug:
         category = get_object_or_404(
@@ -29,29 +55,90 @@ def index(request, category_slug=None):
         )
         books = books.filter(category=category)
 
+    book_settings = models.BookSetting.objects.first()
+    books, previous_cursor, next_cursor = logic.keyset_paginate_books(
+        books,
+        book_settings.books_per_page if book_settings else 20,
+        after=request.GET.get('after'),
+        before=request.GET.get('before'),
+    )
+
     template = 'books/{}/index.html'.format(request.press.theme)
     context = {
         'books': books,
         'category': category,
-        'book_settings': models.BookSetting.objects.first(),
+        'book_settings': book_settings,
+        'previous_cursor': previous_cursor,
+        'next_cursor': next_cursor,
     }
 
     return render(request, template, context)
 
 
+@page_cache.cached_page
 def view_book(request, book_id):
     book = get_object_or_404(
-        models.Book,
+        logic.annotate_access_totals(
+            models.Book.objects.select_related(
+                'category',
+            ).prefetch_related(
+                'contributor_set',
+                'format_set',
+                'chapter_set',
+                'publisher_notes',
+            ),
+        ),
         pk=book_id,
         date_published__isnull=False,
     )
 
+    defer_metrics = page_cache.enabled()
+    etag, last_modified = logic.get_conditional_validators(
+        book.last_modified,
+        book.pk,
+        book.last_modified,
+        request.press.theme,
+        request.user.pk,
+        None if defer_metrics else book.total_downloads,
+        None if defer_metrics else book.total_views,
+    )
+    not_modified = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=last_modified,
+    )
+    if not_modified:
+        return not_modified
+
     template = 'books/{}/book.html'.format(request.press.theme)
     context = {
         'book': book,
+        'chapters': book.chapter_set.all(),
+        'defer_metrics': defer_metrics,
     }
 
-    return render(request, template, context)
+    return logic.set_conditional_headers(
+        render(request, template, context),
+        etag,
+        last_modified,
+    )
+
+
+def book_metrics_json(request, book_id):
+    """
+    Returns live access totals for a book, so cached book pages can show
+    current figures.
+    :param request: HttpRequest
+    :param book_id: Book object PK
+    :return: JsonResponse
+    """
+    book = get_object_or_404(
+        models.Book,
+        pk=book_id,
+        date_published__isnull=False,
+    )
+
+    return JsonResponse(book.metrics())
 
 
 def download_format(request, book_id, format_id, mark_download='yes'):
@@ -61,11 +148,32 @@ def download_format(request, book_id, format_id, mark_download='yes'):
     book = get_object_or_404(models.Book, pk=book_id, date_published__isnull=False)
     format = get_object_or_404(models.Format, pk=format_id, book=book)
 
-    if mark_download == 'yes':
+    # A revalidated download is still a download, so count it either way,
+    # but not resumed downloads or viewers fetching later parts of a file.
+    if mark_download == 'yes' and not files.is_continuation_request(request):
         format.add_book_access(request, 'download')
 
+    etag, last_modified = logic.get_conditional_validators(
+        format.last_modified,
+        format.pk,
+        format.filename,
+        format.last_modified,
+    )
+    not_modified = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=last_modified,
+    )
+    if not_modified:
+        return not_modified
+
     # Handle serving the file here
-    return files.serve_book_file(format)
+    return files.serve_book_file(
+        format,
+        request=request,
+        etag=etag,
+        last_modified=last_modified,
+    )
 
 
 def read_epub(request, book_id, format_id):
@@ -75,9 +183,7 @@ def read_epub(request, book_id, format_id):
     book = get_object_or_404(models.Book, pk=book_id)
     format = get_object_or_404(models.Format, pk=format_id, book=book)
 
-    mime = magic.from_file(files.get_file_path(format), mime=True)
-
-    if not mime == 'application/epub+zip':
+    if not format.is_epub():
         raise Http404
 
     format.add_book_access(request, 'view')
@@ -91,6 +197,58 @@ def read_epub(request, book_id, format_id):
     return render(request, template, context)
 
 
+def read_epub_entry(request, book_id, format_id, entry=None):
+    """
+    Serves a single file from inside an EPUB to the reader.
+    """
+    book = get_object_or_404(models.Book, pk=book_id)
+    format = get_object_or_404(models.Format, pk=format_id, book=book)
+
+    if not entry or not format.is_epub():
+        raise Http404
+
+    file_path = files.get_file_path(format)
+    try:
+        epub_entry = epub.get_index(file_path).get(entry)
+    except (OSError, epub.EpubError):
+        raise Http404
+
+    if epub_entry is None:
+        raise Http404
+
+    etag, last_modified = logic.get_conditional_validators(
+        format.last_modified,
+        format.pk,
+        format.filename,
+        format.last_modified,
+        epub_entry.name,
+        epub_entry.crc,
+    )
+    response = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=last_modified,
+    )
+
+    if not response:
+        try:
+            content = epub.read_entry(file_path, epub_entry)
+        except (OSError, epub.EpubError):
+            raise Http404
+        response = HttpResponse(
+            content,
+            content_type=epub.get_content_type(epub_entry.name),
+        )
+        logic.set_conditional_headers(response, etag, last_modified)
+
+    patch_cache_control(
+        response,
+        public=True,
+        max_age=getattr(settings, 'BOOKS_EPUB_ENTRY_MAX_AGE', 3600),
+    )
+    return response
+
+
 def download_chapter(request, book_id, chapter_id, mark_download='yes'):
     # Forcing a session to be created where people link directly to the book.
     request.session.save()
@@ -106,16 +264,41 @@ def download_chapter(request, book_id, chapter_id, mark_download='yes'):
         book=book,
     )
 
-    if mark_download == 'yes':
+    # A revalidated download is still a download, so count it either way,
+    # but not resumed downloads or viewers fetching later parts of a file.
+    if mark_download == 'yes' and not files.is_continuation_request(request):
         chapter.add_book_access(request, 'download')
 
+    etag, last_modified = logic.get_conditional_validators(
+        chapter.last_modified,
+        chapter.pk,
+        chapter.filename,
+        chapter.last_modified,
+    )
+    not_modified = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=last_modified,
+    )
+    if not_modified:
+        return not_modified
+
     # Handle serving the file here
-    return files.server_chapter_file(chapter)
+    return files.server_chapter_file(
+        chapter,
+        request=request,
+        etag=etag,
+        last_modified=last_modified,
+    )
 
 
 @staff_member_required
 def admin(request):
-    books = models.Book.objects.all()
+    books = logic.annotate_access_totals(
+        models.Book.objects.all(),
+    ).prefetch_related(
+        'contributor_set',
+    )
 
     template = 'books/admin.html'
     context = {
@@ -272,16 +455,57 @@ def import_books_process(request, uuid):
 @staff_member_required
 def export_onix_xml(request, book_id=None):
     books = models.Book.objects.all()
+    deleted_books = models.DeletedBook.objects.all()
 
     if book_id:
         books = models.Book.objects.filter(pk=book_id)
+        deleted_books = deleted_books.filter(book_id=book_id)
+
+    since = None
+    if request.GET.get('since'):
+        since = logic.parse_since(request.GET['since'])
+        if since is None:
+            return HttpResponseBadRequest(
+                'since must be an ISO 8601 date or date and time.',
+            )
 
-    template = 'books/onix.xml'
-    context = {
-        'books': books,
-    }
+    if book_id or since:
+        return onix.stream_onix_xml(
+            request,
+            books,
+            since=since,
+            deleted_books=deleted_books,
+        )
 
-    return render(request, template, context)
+    feed = onix.get_fresh_onix_feed(request)
+    if feed:
+        path, stat = feed
+        etag, last_modified = logic.get_conditional_validators(
+            datetime.fromtimestamp(stat.st_mtime).astimezone(),
+            path,
+            stat.st_size,
+            stat.st_mtime,
+        )
+        response = get_conditional_response(
+            request,
+            etag=etag,
+            last_modified=last_modified,
+        )
+        if not response:
+            response = FileResponse(
+                open(path, 'rb'),
+                content_type='application/xml; charset=utf-8',
+            )
+            response['Content-Encoding'] = 'gzip'
+            # FileResponse names the download after the .gz file, which the
+            # live export does not, and clients would save the XML under it.
+            del response['Content-Disposition']
+            logic.set_conditional_headers(response, etag, last_modified)
+    else:
+        response = onix.stream_onix_xml(request, books)
+
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
 
 
 @staff_member_required
@@ -305,6 +529,7 @@ def book_metrics(request):
         'books': books,
         'data': data,
         'date_form': date_form,
+        'country_cache_info': access.country_cache_info(),
     }
 
     return render(request, template, context)
@@ -326,15 +551,17 @@ def book_metrics_by_month(request):
         }
     )
 
+    if request.POST:
+        return logic.export_metrics_by_month(
+            books,
+            logic.get_report_months(date_parts),
+            breakdown=request.POST.get('breakdown'),
+        )
+
     data, dates, current_year, previous_year = logic.book_metrics_by_month(
         books,
         date_parts,
     )
-    if request.POST:
-        return logic.export_metrics_by_month(
-            dates,
-            data,
-        )
 
     template = 'books/metrics_by_month.html'
     context = {
@@ -401,6 +628,7 @@ def books_chapter(request, book_id, chapter_id=None):
     return render(request, template, context)
 
 
+@page_cache.cached_page
 def view_chapter(request, book_id, chapter_id):
     """
     Displays details of a chapter.
@@ -412,13 +640,33 @@ def view_chapter(request, book_id, chapter_id):
     book = get_object_or_404(models.Book, pk=book_id)
     chapter = get_object_or_404(models.Chapter, pk=chapter_id)
 
+    etag, last_modified = logic.get_conditional_validators(
+        max(book.last_modified, chapter.last_modified),
+        chapter.pk,
+        chapter.last_modified,
+        book.last_modified,
+        request.press.theme,
+        request.user.pk,
+    )
+    not_modified = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=last_modified,
+    )
+    if not_modified:
+        return not_modified
+
     template = 'books/view_chapter.html'
     context = {
         'book': book,
         'chapter': chapter,
     }
 
-    return render(request, template, context)
+    return logic.set_conditional_headers(
+        render(request, template, context),
+        etag,
+        last_modified,
+    )
 
 @staff_member_required
 def categories(request, category_id=None):